@@ -0,0 +1,51 @@
+import contextlib
+import os
+import tempfile
+import threading
+
+# ================= 💾 原子写入 (converter / validator / metrics / shards 共用) =================
+# 先写同目录的临时文件，成功后 os.replace 覆盖目标，读者永远看到完整文件；出错时删掉临时文件
+# mkstemp 建出的文件权限是 0600，os.replace 会原样保留，所以替换前按 umask 改回普通文件的权限 (通常 0644)，
+# 否则 CI 提交的题库、部署后给其他用户 / 抓取进程读的指标与缓存都会变成只有属主可读
+# 读 umask 只能 os.umask(0) 再改回去，中间别的线程建的文件会变成 0666：所以只在第一次写入时读一次，
+# 加锁保证只读一次 (Linux 上优先从 /proc/self/status 读，不动进程的 umask)
+_MODE_LOCK = threading.Lock()
+_file_mode = None
+
+
+def _read_umask():
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith("Umask:"): return int(line.split()[1], 8)
+    except (OSError, ValueError, IndexError):
+        pass
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def file_mode():
+    global _file_mode
+    with _MODE_LOCK:
+        if _file_mode is None: _file_mode = 0o666 & ~_read_umask()
+        return _file_mode
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='wb', encoding=None):
+    """with atomic_open(路径, 'w', 'utf-8') as f: ... 正常退出才替换目标文件"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as f:
+            yield f
+        os.chmod(tmp, file_mode())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+
+
+def atomic_write(path, payload):
+    with atomic_open(path, 'wb') as f:
+        f.write(payload)
@@ -0,0 +1,85 @@
+import atexit
+import os
+import threading
+
+# ================= 📚 库接口 =================
+# 在其他 Python 程序里直接调用抽取与校验，不经过 GitHub Actions：
+#     import autoconvert
+#     questions = list(autoconvert.convert_document("input/第一章.docx"))
+#     for q in autoconvert.validate_questions(questions): ...
+# 导入本模块不读配置、不检查 Key、不建客户端；converter / validator 以及 docx、zhipuai 等依赖在第一次调用时才导入
+# 执行引擎与校验阶段第一次用到时创建，之后在进程内复用 (连接池、切片缓存、限流器状态都是热的)，进程退出时自动关闭
+WARM = {}
+WARM_LOCK = threading.Lock()
+
+
+def load_converter():
+    import converter
+    if not converter.API_KEYS: raise RuntimeError("ZHIPU_KEY_POOL 为空，无法调用模型")
+    return converter
+
+
+def warm(name, create):
+    with WARM_LOCK:
+        if name not in WARM:
+            if not WARM: atexit.register(shutdown)
+            WARM[name] = create()
+        return WARM[name]
+
+
+def shutdown():
+    """关闭常驻的执行引擎与校验阶段 (结论缓存、指标随之落盘)"""
+    with WARM_LOCK:
+        stage, engine = WARM.pop("stage", None), WARM.pop("engine", None)
+    if stage: stage.close()
+    if engine: engine.__exit__(None, None, None)
+
+
+def convert_document(path):
+    """
+    抽取一个 docx 文档，按原文顺序逐题产出，字段与输出文件一致 (category/type/content/options/answer/analysis/chapter/id)
+    所有切片并发提交；相邻切片的重复题只保留更完整的一条，所以等整篇去重完才开始产出
+    文档解析失败抛 ValueError；有切片失败时，其余题目照常产出，最后抛 RuntimeError
+    """
+    conv = load_converter()
+    chunks, err = conv.read_docx_chunks(path)
+    if err: raise ValueError(f"{path} 解析失败: {err}")
+    engine = warm("engine", lambda: conv.make_engine().__enter__())
+
+    fname = os.path.basename(path)
+    futures = [engine.submit((c, i, ans_key, f"{fname}#{i}")) for i, (c, ans_key) in enumerate(chunks)]
+    tracker, kept, errors = {"ids": {}, "dedup": conv.DedupIndex()}, [], []
+    for i, fut in enumerate(futures):
+        qs, err, _ = fut.result()
+        if err:
+            errors.append(err)
+        else:
+            kept.extend(conv.merge_chunk(tracker, fname, qs, i))
+    for q in kept:
+        if q['id'] in tracker["ids"]: yield q
+    if errors: raise RuntimeError(f"{fname} 有 {len(errors)} 个切片抽取失败: {errors[0]}")
+
+
+def validate_questions(questions, batch_size=200):
+    """
+    校验题目：规则预检 → 结论缓存 → 模型，存疑的题目在 analysis 开头写上原因
+    questions 可以是任意可迭代对象，逐批读取、原地改写后按原顺序产出；每批结束结论缓存落盘一次
+    """
+    conv = load_converter()
+    stage = warm("stage", conv.ValidationStage)
+    step = stage.v.BATCH_MAX
+    batch = []
+    for q in questions:
+        batch.append(q)
+        if len(batch) < batch_size: continue
+        yield from validate_batch(stage, batch, step)
+        batch = []
+    if batch: yield from validate_batch(stage, batch, step)
+
+
+def validate_batch(stage, batch, step):
+    # 拆成若干小批并发校验，真正的在途请求数由共享的限流器控制
+    list(stage.pool.map(stage.validate, [batch[i:i + step] for i in range(0, len(batch), step)]))
+    with stage.lock:
+        stage.store.save()
+    return batch
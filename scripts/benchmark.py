@@ -0,0 +1,437 @@
+import argparse
+import collections
+import json
+import math
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# ================= ⚙️ 压测参数 =================
+# 离线压测：本地起一个假的智谱 chat/completions 接口，用合成 docx 语料端到端跑 converter + validator，
+# 不花真实额度。每个语料规模在独立子进程里跑 (模块级状态干净、峰值内存可单独统计)，结果存成 JSON 方便版本间对比
+# 用法：python scripts/benchmark.py --sizes small,medium --p429 0.05 --out bench.json --baseline old.json
+# 合成语料排版规整，默认开启的本地解析会直接吃掉全部题目、不调模型；--local both (默认) 每个规模开/关各跑一轮，两条路径都测到
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(SCRIPTS_DIR)
+CORPUS_SIZES = {"small": (2, 30), "medium": (8, 80), "large": (20, 200)}  # 规模 -> (文档数, 每篇题数)
+RESULT_MARK = "@@BENCH@@ "  # 子进程输出结果行的前缀
+COMPARE_KEYS = ["chunks_per_s", "questions_per_s", "p95_ms", "retries", "prompt_tokens"]
+LOCAL_MODES = {"on": [True], "off": [False], "both": [True, False]}  # --local -> 依次跑的 local_extract 取值
+
+
+def estimate_tokens(text):
+    # 与 converter.estimate_tokens 相同的粗略估算
+    cjk = len(re.findall(r'[\u3000-\u9fff\uff00-\uffef]', text))
+    return cjk + (len(text) - cjk) // 3 + 1
+
+
+def percentile(values, p):
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100.0 * len(ordered)) - 1))]
+
+
+# ================= 🤖 模拟接口 =================
+class MockGLM:
+    """
+    假的智谱接口：延迟服从对数正态分布，可按概率注入 429 / 500 / 截断 / 坏 JSON，
+    max_inflight / key_max_inflight 模拟服务端总的 / 每个 Key 的并发上限 (超出即 429 + 业务码 1302)。流式请求按 SSE 分段返回
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.rand = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.key_in_flight = collections.Counter()
+        self.records = []
+
+    def reset(self):
+        with self.lock:
+            self.records = []
+
+    def roll(self, p):
+        with self.lock:
+            return self.rand.random() < p
+
+    def latency(self):
+        with self.lock:
+            return self.rand.lognormvariate(math.log(self.args.latency_ms / 1000.0), self.args.latency_sigma)
+
+    def record(self, kind, start, prompt, completion, outcome, key=""):
+        with self.lock:
+            self.records.append({"kind": kind, "key": key, "latency": time.time() - start, "outcome": outcome,
+                                 "prompt_tokens": estimate_tokens(prompt), "completion_tokens": estimate_tokens(completion)})
+
+    # ---------- 回复内容 ----------
+    def extract_reply(self, prompt):
+        """按题号行把待处理片段拆成题目，选项/答案尽量照原文填"""
+        chunk = prompt.split("[待处理文本片段]")[-1]
+        key = dict(re.findall(r'(\d+)\.([A-H]+|对|错)', prompt.split("[参考答案库(")[-1].split("\n")[1])) if "[参考答案库(" in prompt else {}
+        # 切片开头带着当前题型标题，中途遇到新标题就换题型；题型 / 分类与 make_corpus 的 SECTIONS 对应
+        qtype, category = "SINGLE_CHOICE", "单选题"
+        items = []
+        for line in chunk.split("\n"):
+            line = line.strip()
+            if line in SECTION_TYPES:
+                qtype, category = SECTION_TYPES[line]
+                continue
+            m = re.match(r'^(\d+)[.、．]\s*(.+)', line)
+            if m:
+                items.append({"category": category, "type": qtype,
+                              "content": m.group(2), "options": [], "answer": key.get(m.group(1), ""), "analysis": ""})
+                continue
+            if not items: continue
+            opt = re.match(r'^([A-H])[.、．]\s*(.+)', line)
+            if opt: items[-1]["options"].append({"label": opt.group(1), "text": opt.group(2)})
+            ans = re.search(r'\[答案\]\s*([A-H]+)', line)
+            if ans: items[-1]["answer"] = ans.group(1)
+        return items
+
+    def validate_reply(self, prompt):
+        if "[待审核题目列表]" in prompt:
+            ids = re.findall(r'题目 (\S+) -', prompt)
+            return json.dumps([{"id": i, "verdict": "CORRECT", "reason": ""} for i in ids], ensure_ascii=False)
+        return "CORRECT"
+
+    def reply(self, kind, prompt):
+        """返回 (内容, finish_reason, 结果类别)"""
+        if kind == "validate":
+            content = self.validate_reply(prompt)
+            if self.roll(self.args.pbad): return content[:len(content) // 2] + ', {"id": ', "stop", "bad"
+            return content, "stop", "ok"
+        items = self.extract_reply(prompt)
+        content = json.dumps(items, ensure_ascii=False)
+        if len(items) >= 2 and self.roll(self.args.ptrunc):
+            return json.dumps(items[:len(items) // 2], ensure_ascii=False)[:-1] + ', {"category": "', "length", "truncated"
+        if self.roll(self.args.pbad):
+            return content[:-1] + ', {"content": "x", }]', "stop", "bad"
+        return content, "stop", "ok"
+
+    # ---------- HTTP ----------
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *a):
+                pass
+
+            def send_json(self, status, obj, headers=None):
+                out = json.dumps(obj, ensure_ascii=False).encode()
+                self.send_response(status)
+                for k, v in (headers or {}).items(): self.send_header(k, v)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def do_POST(self):
+                start = time.time()
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                prompt = body.get("messages", [{}])[0].get("content", "")
+                kind = "validate" if "[待审核题目" in prompt else "extract"
+                key = self.headers.get("Authorization", "").replace("Bearer ", "")
+                with mock.lock:
+                    mock.in_flight += 1
+                    mock.key_in_flight[key] += 1
+                    busy = ((mock.args.max_inflight and mock.in_flight > mock.args.max_inflight) or
+                            (mock.args.key_max_inflight and mock.key_in_flight[key] > mock.args.key_max_inflight))
+                try:
+                    if busy or mock.roll(mock.args.p429):
+                        time.sleep(0.01)
+                        mock.record(kind, start, prompt, "", "429", key)
+                        return self.send_json(429, {"error": {"code": "1302", "message": "并发数过高"}},
+                                              {"Retry-After": str(mock.args.retry_after)})
+                    latency = mock.latency()
+                    if mock.roll(mock.args.p500):
+                        time.sleep(latency / 4)
+                        mock.record(kind, start, prompt, "", "500", key)
+                        return self.send_json(500, {"error": {"code": "500", "message": "mock error"}})
+                    content, finish, outcome = mock.reply(kind, prompt)
+                    usage = {"prompt_tokens": estimate_tokens(prompt), "completion_tokens": estimate_tokens(content)}
+                    if body.get("stream"):
+                        self.stream(content, finish, usage, latency)
+                    else:
+                        time.sleep(latency)
+                        self.send_json(200, {"choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                                                          "finish_reason": finish}], "usage": usage})
+                    mock.record(kind, start, prompt, content, outcome, key)
+                finally:
+                    with mock.lock:
+                        mock.in_flight -= 1
+                        mock.key_in_flight[key] -= 1
+
+            def stream(self, content, finish, usage, latency):
+                # 首包等 30% 的延迟，其余时间均摊到各个分段
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                time.sleep(latency * 0.3)
+                size = max(16, len(content) // 20)
+                pieces = [content[i:i + size] for i in range(0, len(content), size)] or [""]
+                for piece in pieces:
+                    event = {"choices": [{"index": 0, "delta": {"role": "assistant", "content": piece}}]}
+                    self.wfile.write(("data: " + json.dumps(event, ensure_ascii=False) + "\n\n").encode())
+                    self.wfile.flush()
+                    time.sleep(latency * 0.7 / len(pieces))
+                event = {"choices": [{"index": 0, "delta": {}, "finish_reason": finish}], "usage": usage}
+                self.wfile.write(("data: " + json.dumps(event) + "\n\ndata: [DONE]\n\n").encode())
+                self.wfile.flush()
+
+        return Handler
+
+    def start(self):
+        server = ThreadingHTTPServer(("127.0.0.1", self.args.port), self.handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def summary(self, kind):
+        with self.lock:
+            recs = [r for r in self.records if r["kind"] == kind]
+        ok = [r["latency"] * 1000 for r in recs if r["outcome"] in ("ok", "bad", "truncated")]
+        outcomes, keys = {}, collections.Counter(r["key"] for r in recs)
+        for r in recs: outcomes[r["outcome"]] = outcomes.get(r["outcome"], 0) + 1
+        return {
+            "requests": len(recs),
+            "retries": len(recs) - outcomes.get("ok", 0),
+            "outcomes": outcomes,
+            # 请求最多的 Key 占比：Key 池均摊时约为 1 / Key 数
+            "top_key_share": round(max(keys.values()) / len(recs), 3) if recs else 0.0,
+            "p50_ms": round(percentile(ok, 50), 1),
+            "p95_ms": round(percentile(ok, 95), 1),
+            "p99_ms": round(percentile(ok, 99), 1),
+            "prompt_tokens": sum(r["prompt_tokens"] for r in recs),
+            "completion_tokens": sum(r["completion_tokens"] for r in recs),
+        }
+
+
+# ================= 📄 合成语料 =================
+# 每篇的题型段落：(标题, 答案字母数, type, category)；答案字母数 0 为判断题 (无选项，答案 对/错)
+SECTIONS = [("一、单项选择题", 1, "SINGLE_CHOICE", "单选题"), ("二、多项选择题", 2, "MULTI_CHOICE", "X型题"),
+            ("三、判断题", 0, "TRUE_FALSE", "判断题")]
+SECTION_TYPES = {title: (qtype, category) for title, _, qtype, category in SECTIONS}
+
+def make_corpus(input_dir, docs, questions, seed):
+    """每篇：单选 + 多选 + 判断三段，部分题目自带答案，其余答案放在文末的答案表里"""
+    from docx import Document
+    rand = random.Random(seed)
+    os.makedirs(input_dir, exist_ok=True)
+    for d in range(docs):
+        doc = Document()
+        per = max(1, questions // len(SECTIONS))
+        key = []
+        for title, width, _, _ in SECTIONS:
+            doc.add_paragraph(title)
+            for n in range(1, per + 1):
+                doc.add_paragraph(f"{n}. 第{d + 1}篇{title[2:]}第{n}题：关于合成语料编号{rand.randint(1000, 9999)}的说法正确的是( )")
+                if width == 0:
+                    key.append((title, n, rand.choice(["对", "错"])))
+                    continue
+                for label in "ABCDE"[:4 + (width > 1)]:
+                    doc.add_paragraph(f"{label}. 选项{label}{rand.randint(10, 99)}")
+                answer = "".join(sorted(rand.sample("ABCD", width)))
+                if rand.random() < 0.5:
+                    doc.add_paragraph(f"[答案]{answer} [解析]见第{n}节")
+                else:
+                    key.append((title, n, answer))
+        doc.add_paragraph("参考答案")
+        for title, _, _, _ in SECTIONS:
+            entries = [f"{n}.{a}" for t, n, a in key if t == title]
+            if not entries: continue
+            doc.add_paragraph(title)
+            table = doc.add_table(rows=(len(entries) + 4) // 5, cols=5)
+            for i, entry in enumerate(entries): table.cell(i // 5, i % 5).text = entry
+        doc.save(os.path.join(input_dir, f"bench_{d + 1:03d}.docx"))
+
+
+# ================= 🏃 子进程：端到端跑一轮 =================
+def run_child(workspace):
+    os.chdir(workspace)
+    sys.path.insert(0, SCRIPTS_DIR)
+    import converter
+
+    t0 = time.time()
+    converter.main()
+    convert_s = time.time() - t0
+
+    with open(converter.MANIFEST_FILE, 'r', encoding='utf-8') as f:
+        bank = converter.bank_path(json.load(f)["target"])
+    if bank.endswith(converter.shards.INDEX_NAME):
+        # 分片布局：题数直接取索引，不必打开分片
+        questions = converter.shards.load_index(bank)["total"]
+    else:
+        with open(bank, 'r', encoding='utf-8') as f:
+            questions = len(json.load(f)["data"])
+    files = sorted(n for n in os.listdir(converter.INPUT_DIR) if n.endswith(".docx"))
+    chunks = sum(len(converter.read_docx_chunks(os.path.join(converter.INPUT_DIR, n))[0]) for n in files)
+
+    # 融合模式下校验已在 converter.main 里完成；否则像 workflow 一样接着跑 validator
+    validate_s = 0.0
+    if not converter.FUSED_VALIDATE:
+        import validator
+
+        t1 = time.time()
+        validator.main()
+        validate_s = time.time() - t1
+
+    print(RESULT_MARK + json.dumps({
+        "chunks": chunks, "questions": questions, "convert_s": convert_s, "validate_s": validate_s,
+        "fused": bool(converter.FUSED_VALIDATE),
+        # Linux 下 ru_maxrss 单位为 KB
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+    }), flush=True)
+
+
+# ================= 📊 主流程 =================
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_size(name, args, mock, root, local):
+    docs, per_doc = CORPUS_SIZES[name]
+    label = f"{name} (本地解析{'开' if local else '关'})"
+    workspace = os.path.join(root, f"{name}-{'local' if local else 'model'}")
+    make_corpus(os.path.join(workspace, "input"), docs, per_doc, args.seed)
+    os.makedirs(os.path.join(workspace, "output"), exist_ok=True)
+
+    config = {}
+    if os.path.exists(os.path.join(REPO_DIR, "config.json")):
+        with open(os.path.join(REPO_DIR, "config.json"), 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    config.setdefault("rate_limit", {})["key_rpm"] = args.key_rpm
+    config["local_extract"] = local
+    if args.layout: config["output_layout"] = args.layout
+    with open(os.path.join(workspace, "config.json"), 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False)
+
+    env = {k: v for k, v in os.environ.items() if k not in ("PUSHPLUS_TOKEN", "SMTP_USER", "SMTP_PASS")}
+    env.update({
+        "ZHIPU_KEY_POOL": ",".join(f"bench-key-{i:04d}" for i in range(args.keys)),
+        "ZHIPUAI_BASE_URL": f"http://127.0.0.1:{args.port}",
+        "CONVERTER_CACHE_DIR": os.path.join(workspace, "cache"),  # 冷缓存，每次都真实请求
+    })
+    if args.engine: env["CONVERTER_ENGINE"] = args.engine
+    if args.fused: env["CONVERTER_VALIDATE"] = "1"
+
+    mock.reset()
+    print(f"🏃 {label}: {docs} 篇 x {per_doc} 题 ...", flush=True)
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", workspace], env=env,
+                          capture_output=True, text=True)
+    with open(os.path.join(workspace, "run.log"), 'w', encoding='utf-8') as f:
+        f.write(proc.stdout + proc.stderr)
+    lines = [l for l in proc.stdout.splitlines() if l.startswith(RESULT_MARK)]
+    if proc.returncode != 0 or not lines:
+        print(f"❌ {label} 运行失败 (exit {proc.returncode})，日志见 {workspace}/run.log")
+        return {"corpus": name, "local_extract": local, "error": (proc.stderr or proc.stdout)[-2000:]}
+
+    child = json.loads(lines[-1][len(RESULT_MARK):])
+    convert, validate = mock.summary("extract"), mock.summary("validate")
+    convert.update({"seconds": round(child["convert_s"], 2),
+                    "chunks_per_s": round(child["chunks"] / max(child["convert_s"], 1e-6), 2),
+                    "questions_per_s": round(child["questions"] / max(child["convert_s"], 1e-6), 2)})
+    # 融合模式两阶段重叠，校验吞吐按端到端时间算
+    validate_s = child["convert_s"] if child["fused"] else child["validate_s"]
+    validate.update({"seconds": round(child["validate_s"], 2),
+                     "questions_per_s": round(child["questions"] / max(validate_s, 1e-6), 2)})
+    result = {"corpus": name, "local_extract": local, "docs": docs, "chunks": child["chunks"], "questions": child["questions"],
+              "fused": child["fused"], "end_to_end_s": round(child["convert_s"] + child["validate_s"], 2),
+              "peak_rss_mb": child["peak_rss_mb"], "convert": convert, "validate": validate}
+    print(f"   ✅ 转换 {convert['seconds']}s ({convert['chunks_per_s']} 切片/s, {convert['questions_per_s']} 题/s, "
+          f"p95 {convert['p95_ms']}ms, 重试 {convert['retries']}, 单 Key 占比 {convert['top_key_share']}) | 校验 {validate['seconds']}s "
+          f"({validate['questions_per_s']} 题/s) | 端到端 {result['end_to_end_s']}s | 峰值内存 {child['peak_rss_mb']}MB",
+          flush=True)
+    return result
+
+
+def compare(report, baseline_file):
+    """与旧结果逐项对比，打印变化比例"""
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        old = {(r["corpus"], r.get("local_extract", True)): r for r in json.load(f).get("runs", []) if "error" not in r}
+    for run in report["runs"]:
+        prev = old.get((run["corpus"], run["local_extract"]))
+        if not prev or "error" in run: continue
+        for phase in ("convert", "validate"):
+            parts = []
+            for key in COMPARE_KEYS:
+                a, b = prev[phase].get(key), run[phase].get(key)
+                if a is None or b is None: continue
+                delta = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+                parts.append(f"{key} {a} -> {b} ({delta})")
+            mode = "local" if run["local_extract"] else "model"
+            print(f"📈 {run['corpus']}/{mode}/{phase}: " + "; ".join(parts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="converter / validator 离线压测")
+    parser.add_argument("--sizes", default="small,medium", help="语料规模，逗号分隔：" + ",".join(CORPUS_SIZES))
+    parser.add_argument("--engine", default="", help="converter 执行引擎 thread / async，默认读配置")
+    parser.add_argument("--fused", action="store_true", help="converter --validate 融合模式，不再单独跑 validator")
+    parser.add_argument("--layout", default="", choices=["", "single", "sharded"], help="输出布局，默认读配置")
+    parser.add_argument("--local", default="both", choices=list(LOCAL_MODES),
+                        help="本地解析：on 只测本地路径，off 全部走模型，both 两种各跑一轮")
+    parser.add_argument("--keys", type=int, default=4, help="模拟的 Key 数量")
+    parser.add_argument("--key-rpm", type=int, default=0, help="客户端每个 Key 的 RPM，0 表示不限")
+    parser.add_argument("--latency-ms", type=float, default=300, help="模拟接口延迟中位数")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="对数正态分布的 sigma，越大长尾越重")
+    parser.add_argument("--max-inflight", type=int, default=0, help="服务端并发上限，超出返回 429，0 表示不限")
+    parser.add_argument("--key-max-inflight", type=int, default=4, help="服务端每个 Key 的并发上限，超出返回 429，0 表示不限")
+    parser.add_argument("--p429", type=float, default=0.0, help="随机 429 概率")
+    parser.add_argument("--p500", type=float, default=0.0, help="随机 500 概率")
+    parser.add_argument("--ptrunc", type=float, default=0.0, help="回复被 max_tokens 截断的概率")
+    parser.add_argument("--pbad", type=float, default=0.0, help="回复 JSON 损坏的概率")
+    parser.add_argument("--retry-after", type=float, default=0.5, help="429 携带的 Retry-After 秒数")
+    parser.add_argument("--port", type=int, default=18765)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="benchmark_result.json", help="结果 JSON 路径")
+    parser.add_argument("--baseline", default="", help="旧的结果 JSON，给出对比")
+    parser.add_argument("--keep", action="store_true", help="保留临时工作目录")
+    parser.add_argument("--child", default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child: return run_child(args.child)
+
+    sizes = [s.strip() for s in args.sizes.split(",") if s.strip()]
+    unknown = [s for s in sizes if s not in CORPUS_SIZES]
+    if unknown: parser.error(f"未知的语料规模: {', '.join(unknown)}")
+
+    mock = MockGLM(args)
+    server = mock.start()
+    root = tempfile.mkdtemp(prefix="auto-convert-bench-")
+    params = {k: v for k, v in vars(args).items() if k not in ("child", "out", "baseline", "keep")}
+    report = {"commit": git_commit(), "time": time.strftime("%Y-%m-%d %H:%M:%S"), "params": params, "runs": []}
+    try:
+        for name in sizes:
+            for local in LOCAL_MODES[args.local]:
+                report["runs"].append(run_size(name, args, mock, root, local))
+    finally:
+        server.shutdown()
+        if args.keep:
+            print(f"📁 工作目录保留在 {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 结果已保存到 {args.out}")
+    if args.baseline: compare(report, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,30 @@
 import json
 import os
+import sys
 import uuid
 import time
-import requests
-import random
 import re
 import datetime
-import smtplib
-from email.mime.text import MIMEText
-from email.header import Header
-from docx import Document
-from zhipuai import ZhipuAI
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import unicodedata
+import threading
+import queue
+import collections
+import asyncio
+import signal
+import socket
+import sqlite3
+import contextlib
+import concurrent.futures
+from ratelimit import RateController, NoKeyAvailable
+from metrics import MetricsRecorder
+import shards
+from atomicfile import atomic_open, atomic_write
+from rules import TRUE_FALSE_ANSWERS
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# docx / zhipuai / httpx / requests / smtplib 都在用到时才导入：
+# 作为库被 import (autoconvert.py) 时没有任何副作用，也不为用不到的依赖付启动时间
 
 # ================= 🛡️ 配置加载 =================
 CONFIG_FILE = "config.json"
@@ -33,6 +46,12 @@ SUBJECT = APP_CONFIG.get("subject_name", "通用学科")
 DESC = APP_CONFIG.get("description", "")
 INPUT_DIR = "input"
 OUTPUT_DIR = "output"
+MANIFEST_FILE = os.path.join(OUTPUT_DIR, "manifest.json")  # 随 output/*.json 一起提交
+DEAD_LETTER_FILE = os.path.join(OUTPUT_DIR, "dead_letter.json")  # 重试耗尽的切片，可用 --replay 重放
+COMPACT_OUTPUT = APP_CONFIG.get("compact_output", True)  # 运行结束时把 NDJSON 日志压实为旧版 JSON
+OUTPUT_LAYOUT = APP_CONFIG.get("output_layout", "single")  # single: 单个 outputN.json / sharded: outputN/ 按章节分片 + 索引
+OUTPUT_GZIP = APP_CONFIG.get("output_gzip", False)  # 分片模式下分片是否 gzip 压缩
+OUTPUT_VERSION = "MultiKey-V13-AutoSave"
 
 # 📧 邮件配置
 SMTP_HOST = os.getenv("SMTP_HOST", "smtp.163.com")
@@ -51,50 +70,226 @@ if KEY_POOL_STR:
     API_KEYS = [k.strip() for k in re.split(r'[,\n\s]+', KEY_POOL_STR) if k.strip()]
 else:
     API_KEYS = []
-if not API_KEYS:
-    print("❌ 严重错误：ZHIPU_KEY_POOL 为空！")
-    if __name__ == "__main__": exit(1)
 
 # ================= ⚙️ 性能策略 (稳健版) =================
-MAX_WORKERS = 4  # 并发数
+MAX_WORKERS = 4  # 初始并发数 (之后由 RATE 按接口反馈自动增减)
+QUEUE_DEPTH = MAX_WORKERS * 2  # 已切好、等待执行的切片上限 (控制内存)
+REPLAY = os.getenv("CONVERTER_REPLAY") == "1"  # 本次运行顺带重放死信 (命令行 --replay)
+# 融合模式：抽取与校验同时进行、共用一个限流器，题目校验完才写入输出 (不必再单独跑 validator.py；命令行 --validate)
+FUSED_VALIDATE = os.getenv("CONVERTER_VALIDATE") == "1" or APP_CONFIG.get("fused_validate", False)
+LAST_FILE = "last_generated_file.txt"  # validator.py 单独运行时从这里找目标文件
+WATCH_INTERVAL = APP_CONFIG.get("watch_interval", 2)  # 常驻模式轮询 input/ 的间隔 (秒)
+WATCH_NOTIFY = APP_CONFIG.get("watch_notify", True)  # 常驻模式每轮是否推送报告
+PARSE_WORKERS = APP_CONFIG.get("parse_workers", min(4, os.cpu_count() or 1))  # 文档解析进程数，0 表示在生产者线程内解析
+ENGINE = os.getenv("CONVERTER_ENGINE", APP_CONFIG.get("engine", "thread"))  # thread / async / queue (分布式)
+ASYNC_CONCURRENCY = APP_CONFIG.get("async_concurrency", 64)  # async 引擎的在途请求上限
+RATE_CONFIG = APP_CONFIG.get("rate_limit", {})
+MAX_CONCURRENCY = RATE_CONFIG.get("max_concurrency", 32)  # thread 引擎的在途请求上限
+ZHIPU_BASE_URL = os.getenv("ZHIPUAI_BASE_URL", "https://open.bigmodel.cn/api/paas/v4")  # 与 SDK 读取同一个环境变量
 AI_MODEL_NAME = "glm-4-flash"
-CHUNK_SIZE = 800  # 切片大小
+CHUNK_SIZE = 800  # 切片大小 (超长单题兜底切分时使用)
 OVERLAP = 100
-MAX_RETRIES = 5  # 重试次数
-API_TIMEOUT = 80  # 超时时间
+CHUNK_TOKENS = APP_CONFIG.get("chunk_tokens", 800)  # 按题目打包时每个切片的 token 预算
+MIN_CHUNK_TOKENS = 100  # 截断后学习到的切片预算下限
+SPLIT_DEPTH = APP_CONFIG.get("split_depth", 3)  # 输出被 max_tokens 截断时，切片最多对半拆分的层数
+MAX_RETRIES = APP_CONFIG.get("chunk_max_attempts", 5)  # 单个切片允许的失败次数 (限流不计入)
+CHUNK_TIME_BUDGET = APP_CONFIG.get("chunk_time_budget", 900)  # 单个切片最长处理秒数，超出即进死信
+API_TIMEOUT = 80  # 超时时间 (async 引擎下整个请求含流式读取的上限)
+STREAM = APP_CONFIG.get("stream", True)  # 流式接收回复，边收边解析
+LOCAL_EXTRACT = APP_CONFIG.get("local_extract", True)  # 排版规整的题目本地正则解析，不调模型
+LOCAL_MIN_CONFIDENCE = APP_CONFIG.get("local_min_confidence", 0.8)  # 本地解析置信度低于此值的题目交给模型
 RETRY_DELAY = 2  # 冷却时间
 PUSHPLUS_TOKEN = os.getenv("PUSHPLUS_TOKEN")
 
+# 🎛️ 采样参数 (参与缓存键计算，改动后旧缓存自动失效)
+TEMPERATURE = 0.1
+TOP_P = 0.7
+MAX_TOKENS = 4000
+REQUEST_TIMEOUT = 45
+PROMPT_VERSION = "V18"  # 修改提示词模板时务必递增
+LOCAL_VERSION = "L2"  # 修改本地解析规则时务必递增
+
+# 💾 切片缓存 (放在 workspace 之外，避免 checkout 清理时被删除)
+CACHE_DIR = os.getenv("CONVERTER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "auto-convert"))
+CACHE_MAX_MB = APP_CONFIG.get("cache_max_mb", 200)
+
+# 🛰️ 分布式队列 (engine = "queue")：多台机器时 QUEUE_DB 必须放在各机器共享的卷上
+QUEUE_DB = os.getenv("CONVERTER_QUEUE_DB", APP_CONFIG.get("queue_db", os.path.join(CACHE_DIR, "queue.sqlite3")))
+QUEUE_LEASE = APP_CONFIG.get("queue_lease", 60)  # 领取切片的租约秒数，worker 每 1/3 租约续约一次
+QUEUE_MAX_CLAIMS = APP_CONFIG.get("queue_max_claims", 3)  # 租约过期 (worker 掉线) 被重新领取的次数上限
+QUEUE_WINDOW = APP_CONFIG.get("queue_window", 256)  # 协调进程同时挂在队列里的切片数上限
+QUEUE_LOCAL_WORKER = APP_CONFIG.get("queue_local_worker", True)  # 协调进程自己也领取切片
+QUEUE_IDLE_EXIT = APP_CONFIG.get("queue_idle_exit", 60)  # --worker 空闲多少秒后退出，0 表示常驻
+QUEUE_POLL = 0.2  # 领取/收取结果的轮询间隔
+QUEUE_MAX_ERRORS = 5  # 协调进程连续访问队列库失败这么多次，本轮未完成的切片全部转入死信
+
+# 📈 结构化指标：每次运行覆盖写 converter.ndjson / converter.prom
+METRICS_DIR = os.getenv("CONVERTER_METRICS_DIR", APP_CONFIG.get("metrics_dir", os.path.join(CACHE_DIR, "metrics")))
+REPORT_SLOWEST = APP_CONFIG.get("report_slowest", 10)  # 报告里列出最慢的切片数
+
+# 🚦 限流器：每个 Key 一个令牌桶 + AIMD 自适应并发 (与 validator 共用实现)
+RATE = RateController(API_KEYS, key_rpm=RATE_CONFIG.get("key_rpm", 60), burst=RATE_CONFIG.get("burst", 5),
+                      start=MAX_WORKERS, max_limit=ASYNC_CONCURRENCY if ENGINE == "async" else MAX_CONCURRENCY)
+
 # ================= 📝 全局日志 =================
-EXECUTION_LOGS = []
+EXECUTION_LOGS = collections.deque(maxlen=50)  # 只留最近的告警/错误给报告，逐切片的耗时走 METRICS
+METRICS = MetricsRecorder("converter", capacity=APP_CONFIG.get("metrics_buffer", 2000), slow_n=REPORT_SLOWEST)
 
 
 def log_record(msg, level="INFO"):
     timestamp = datetime.datetime.now().strftime("%H:%M:%S")
     icon = "✅" if level == "INFO" else "❌" if level == "ERROR" else "⚠️"
     print(f"[{timestamp}] {icon} {msg}", flush=True)
+    if level != "INFO": EXECUTION_LOGS.append((timestamp, level, msg))
 
-    color = "#333"
-    if level == "ERROR": color = "red"
-    if level == "WARN": color = "#d35400"
-    if "Chunk" in msg and level == "INFO": color = "green"
-    log_line = f"<div style='color:{color}; border-bottom:1px dashed #eee; padding:4px 0;'>[{timestamp}] {msg}</div>"
-    EXECUTION_LOGS.append(log_line)
+
+# ================= 💾 切片缓存 =================
+class ChunkCache:
+    """
+    内容寻址的磁盘缓存：键 = sha256(切片 + 提示词版本 + 学科 + 模型 + 采样参数)
+    - 写入：临时文件 + os.replace，进程被杀也不会留下半截文件
+    - 淘汰：总大小超过上限时按最近使用时间 (LRU) 删除最旧条目
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.index = collections.OrderedDict()  # key -> size，按使用时间从旧到新
+        self.total = 0
+        os.makedirs(root, exist_ok=True)
+
+        entries = []
+        for name in os.listdir(root):
+            if not name.endswith(".json"): continue
+            try:
+                st = os.stat(os.path.join(root, name))
+                entries.append((st.st_mtime, name[:-5], st.st_size))
+            except OSError:
+                pass
+        for _, key, size in sorted(entries):
+            self.index[key] = size
+            self.total += size
+
+    def _path(self, key):
+        return os.path.join(self.root, key + ".json")
+
+    def reset_counts(self):
+        with self.lock:
+            self.hits = self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.index:
+                self.misses += 1
+                return None
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            os.utime(self._path(key))  # 刷新 mtime，重启后 LRU 顺序依然有效
+        except (OSError, ValueError):
+            with self.lock:
+                self.total -= self.index.pop(key, 0)
+                self.misses += 1
+            return None
+        with self.lock:
+            if key in self.index: self.index.move_to_end(key)
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        try:
+            atomic_write(self._path(key), payload)
+        except OSError as e:
+            print(f"   ⚠️ 缓存写入失败: {e}", flush=True)
+            return
+        with self.lock:
+            self.total -= self.index.pop(key, 0)
+            self.index[key] = len(payload)
+            self.total += len(payload)
+            while self.total > self.max_bytes and len(self.index) > 1:
+                old_key, old_size = self.index.popitem(last=False)
+                self.total -= old_size
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+
+
+def chunk_cache_key(chunk, ans_key):
+    raw = json.dumps([PROMPT_VERSION, LOCAL_VERSION if LOCAL_EXTRACT else "", SUBJECT, AI_MODEL_NAME, TEMPERATURE, TOP_P, MAX_TOKENS, ans_key[:3000], chunk],
+                     ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+CHUNK_CACHE = None
+
+
+def get_chunk_cache():
+    global CHUNK_CACHE
+    if CHUNK_CACHE is None:
+        try:
+            CHUNK_CACHE = ChunkCache(CACHE_DIR, CACHE_MAX_MB * 1024 * 1024)
+        except OSError as e:
+            log_record(f"缓存目录不可用，本次不使用缓存: {e}", "WARN")
+            CHUNK_CACHE = False
+    return CHUNK_CACHE
 
 
 # ================= 🛠️ 核心功能 =================
-def get_random_client():
-    selected_key = random.choice(API_KEYS)
-    return ZhipuAI(api_key=selected_key), selected_key[-4:]
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(key):
+    # 每个 Key 只建一个客户端，复用其 HTTP 连接池；重试交给限流器，SDK 自身不再重试
+    with CLIENTS_LOCK:
+        client = CLIENTS.get(key)
+        if client is None:
+            from zhipuai import ZhipuAI
+            client = CLIENTS[key] = ZhipuAI(api_key=key, max_retries=0)
+    return client
 
 
-def read_docx(file_path):
-    if not os.path.exists(file_path): return ""
+def iter_docx_blocks(file_path):
+    """
+    按文档顺序逐块产出文本：段落一行，表格每行一行 (单元格用 " | " 连接，合并单元格只取一次)
+    很多试卷把选项和答案放在表格里，所以表格不能丢
+    """
+    from docx import Document
+    from docx.table import Table
+    from docx.text.paragraph import Paragraph
+    doc = Document(file_path)
+    body = doc.element.body
+    for child in body.iterchildren():
+        tag = child.tag.rsplit("}", 1)[-1]
+        if tag == "p":
+            text = Paragraph(child, doc).text.strip()
+            if text: yield text
+        elif tag == "tbl":
+            for row in Table(child, doc).rows:
+                cells, seen = [], set()
+                for cell in row.cells:
+                    if id(cell._tc) in seen: continue
+                    seen.add(id(cell._tc))
+                    text = " ".join(cell.text.split())
+                    if text: cells.append(text)
+                if cells: yield " | ".join(cells)
+
+
+def read_docx_chunks(file_path):
+    """
+    解析进程里执行：先把答案页从正文里拿出来建索引，再按题目打包切片
+    返回 ([(切片, 本切片的答案)], 错误信息)；解析失败不再悄悄返回空串
+    """
     try:
-        doc = Document(file_path)
-        return "\n".join([p.text.strip() for p in doc.paragraphs if p.text.strip()])
-    except:
-        return ""
+        body, index = split_answer_key(list(iter_docx_blocks(file_path)))
+        return [(c, chunk_answers(c, index)) for c in pack_chunks(body, CHUNK_TOKENS)], None
+    except Exception as e:
+        return [], f"{type(e).__name__}: {e}"
 
 
 def get_chunks(text, size, overlap):
@@ -109,6 +304,155 @@ def get_chunks(text, size, overlap):
     return chunks
 
 
+# 题目起始：3. / 3、 / 3) / （3） / 第3题 ；排除 3.5 这类小数
+QUESTION_START = re.compile(r'^\s*(?:第\s*\d+\s*题|[（(]\s*\d+\s*[)）]|\d+\s*[.、．)）](?!\d))')
+# 题型标题：A1型题 / 一、单项选择题 / 三、判断题 ...
+SECTION_HEADER = re.compile(
+    r'^\s*(?:[一二三四五六七八九十]+\s*[、.．]\s*)?'
+    r'(?:[ABX]\d?\s*型题|(?:单项|多项|不定项)?选择题|单选题|多选题|判断题|填空题|简答题|名词解释|计算题|论述题|编程题|病例分析)')
+CJK_CHAR = re.compile(r'[\u3000-\u9fff\uff00-\uffef]')
+
+
+def estimate_tokens(text):
+    # 粗略估算：中文约 1 字 1 token，其余字符约 3 个 1 token
+    cjk = len(CJK_CHAR.findall(text))
+    return cjk + (len(text) - cjk) // 3 + 1
+
+
+def split_questions(lines):
+    """
+    按题目边界切分：把每道题 (题号行 + 后续行) 视为不可拆分的块
+    题型标题单独成块，并记录为当前标题
+    逐行扫描一次，线性时间；产出 (所属标题, 块文本)
+    """
+    header, block = "", []
+    for line in lines:
+        if len(line) <= 30 and SECTION_HEADER.match(line):
+            if block: yield header, "\n".join(block)
+            header, block = line.strip(), []
+        elif QUESTION_START.match(line):
+            if block: yield header, "\n".join(block)
+            block = [line]
+        else:
+            block.append(line)
+    if block: yield header, "\n".join(block)
+
+
+def pack_chunks(lines, budget):
+    """
+    把整题打包进不超过 budget tokens 的切片，题目不会在切片边界被截断，也不再需要重叠
+    - 每个切片开头补上当前题型标题，模型能看到题目所属的分类
+    - 单题超出预算时退回到定长重叠切分 (get_chunks)
+    """
+    buf, used, buf_header = [], 0, None
+    for header, block in split_questions(lines):
+        cost = estimate_tokens(block)
+        if buf and (used + cost > budget or header != buf_header):
+            yield "\n".join(buf)
+            buf, used = [], 0
+        if not buf:
+            buf_header = header
+            if header:
+                buf.append(header)
+                used = estimate_tokens(header)
+        if used + cost > budget:
+            prefix = (header + "\n") if header else ""
+            for piece in get_chunks(block, CHUNK_SIZE, OVERLAP):
+                yield prefix + piece
+            buf, used = [], 0
+            continue
+        buf.append(block)
+        used += cost
+    if buf: yield "\n".join(buf)
+
+
+# 答案页：「参考答案」标题后逐行排列的「1.A 2.C 3.BD」「1-5 ABCDA」，或整行都是答案的表格行
+ANSWER_HEADER = re.compile(r'^\s*[【\[]?\s*(?:参考|标准)?答案(?:与解析|及解析|速查)?\s*[】\]]?\s*[:：]?\s*')
+ANSWER_TOKEN = r'([A-Ha-h]{1,8}|[√×✓✗对错]|正确|错误)'
+# 题号最多 5 位 (万题级题库)；「2023年」「2021级」这类年份不当题号
+ANSWER_NUM = r'(?<!\d)(?!(?:19|20)\d\d\s*[年级届版])(\d{1,5})'
+ANSWER_ENTRY = re.compile(ANSWER_NUM + r'\s*[.、．:：)）]?\s*' + ANSWER_TOKEN + r'(?![A-Za-z])')
+ANSWER_RANGE = re.compile(ANSWER_NUM + r'\s*[-~—–]\s*(\d{1,5})\s*[.、．:：]?\s*([A-Ha-h]{2,})(?![A-Za-z])')
+ANSWER_LEAD = re.compile(r'^\s*' + ANSWER_NUM + r'\s*[.、．:：)）]?\s*(?:答案\s*[:：]?\s*)?' + ANSWER_TOKEN + r'(?=\s|$|[，,;；|【\[(（]|解析)')
+SECTION_ORDINAL = re.compile(r'^\s*[一二三四五六七八九十]+\s*[、.．]\s*')
+
+
+def section_key(header):
+    # 正文和答案页的题型标题写法可能不同 (带不带序号)，统一后作为分组键
+    return normalize_category(SECTION_ORDINAL.sub("", header)) if header else ""
+
+
+def parse_answer_line(line):
+    """解析一行里的答案条目，返回 ([(题号, 答案)], 覆盖率)；覆盖率 = 条目占该行有效字符的比例"""
+    entries, covered = [], 0
+    for m in ANSWER_RANGE.finditer(line):
+        start, end, letters = int(m.group(1)), int(m.group(2)), m.group(3).upper()
+        if end - start + 1 != len(letters): continue
+        entries.extend((start + k, ch) for k, ch in enumerate(letters))
+        covered += len("".join(m.group(0).split()))
+    for m in ANSWER_ENTRY.finditer(ANSWER_RANGE.sub(" ", line)):
+        ans = m.group(2)
+        entries.append((int(m.group(1)), ans.upper() if ans.isascii() else ans))
+        covered += len("".join(m.group(0).split()))
+    size = len(re.sub(r'[\s|,，;；]', '', line))
+    return entries, covered / size if size else 0.0
+
+
+def split_answer_key(lines):
+    """
+    预扫描整篇文档，把答案页从正文里拿出来，建成 {(题型, 题号): 答案} 索引
+    - 「参考答案」标题之后逐行读答案，题型小标题切换分组，遇到不像答案的行即回到正文
+    - 没有标题时，至少 3 个条目且几乎整行都是答案的行 (如答案表格) 也算答案页
+    返回 (正文行列表, 索引)
+    """
+    body, index = [], {}
+    in_key, section = False, ""
+    for line in lines:
+        m = ANSWER_HEADER.match(line)
+        if m:
+            rest = line[m.end():]
+            entries, _ = parse_answer_line(rest)
+            # 「[答案]A [解析]...」是题目自带的答案，不是答案页
+            if entries or not rest.strip():
+                in_key, section = True, ""
+                for num, ans in entries: index[(section, num)] = ans
+                continue
+        if in_key:
+            hm = SECTION_HEADER.match(line)
+            if hm:
+                section = section_key(hm.group(0))
+                line = line[hm.end():]
+            entries, coverage = parse_answer_line(line)
+            lead = ANSWER_LEAD.match(line)
+            if hm or lead or (entries and coverage >= 0.5):
+                if lead and coverage < 0.5: entries = [(int(lead.group(1)), lead.group(2).upper())]
+                for num, ans in entries: index[(section, num)] = ans
+                continue
+            in_key, section = False, ""
+        else:
+            entries, coverage = parse_answer_line(line)
+            if len(entries) >= 3 and coverage >= 0.8:
+                for num, ans in entries: index[("", num)] = ans
+                continue
+        body.append(line)
+    return body, index
+
+
+def chunk_answers(chunk, index):
+    """只取本切片出现的题号对应的答案，作为提示词里的答案库"""
+    if not index: return ""
+    lines = chunk.split("\n")
+    section = section_key(lines[0]) if SECTION_HEADER.match(lines[0]) else ""
+    out = []
+    for line in lines:
+        m = QUESTION_START.match(line)
+        if not m: continue
+        num = int(re.search(r'\d+', m.group(0)).group(0))
+        ans = index.get((section, num)) or index.get(("", num))
+        if ans: out.append(f"{num}.{ans}")
+    return " ".join(out)
+
+
 def normalize_category(raw):
     if not raw: return "综合题"
     cat = raw.strip()
@@ -126,34 +470,343 @@ def normalize_category(raw):
     return cat if cat.endswith("题") else cat + "题"
 
 
-def repair_json(jstr):
-    jstr = jstr.strip()
-    if "```json" in jstr:
-        jstr = jstr.split("```json")[1].split("```")[0]
-    elif "```" in jstr:
-        jstr = jstr.split("```")[1].split("```")[0]
-    jstr = jstr.strip()
-    if not jstr.endswith("]"):
-        idx = jstr.rfind("}")
-        if idx != -1:
-            jstr = jstr[:idx + 1] + "]"
-        else:
-            return "[]"
-    return jstr
-
+# 🧩 本地解析：排版规整的题目 (题号 + 题干 + A. B. 选项 + [答案] [解析]) 直接用正则提取，不走模型
+# 每道题给一个置信度，低于 LOCAL_MIN_CONFIDENCE 或解析不了的块才拼起来交给模型
+OPTION_LABEL = re.compile(r'(?:^|(?<=[\s)）]))([A-H])\s*[.、．)）]\s*')
+# 题干里也可能出现「答案」「解析」字样，所以要求带括号或冒号
+INLINE_ANSWER = re.compile(r'(?:[\[【]\s*(?:正确|参考)?答案\s*[\]】]\s*[:：]?|(?:正确|参考)?答案\s*[:：])\s*')
+INLINE_ANALYSIS = re.compile(r'(?:[\[【]\s*(?:答案)?解析\s*[\]】]\s*[:：]?|(?:答案)?解析\s*[:：])\s*')
+KEY_ENTRY = re.compile(r'(\d+)\.(\S+)')  # chunk_answers 产出的「3.A 4.BD」
+CHOICE_LETTERS = re.compile(r'^[A-H]+$')
+TYPE_CATEGORIES = {"SINGLE_CHOICE": "单选题", "MULTI_CHOICE": "X型题", "TRUE_FALSE": "判断题"}
+SHARED_TYPES = ("A3", "A4", "B1")  # 几道题共用病例或选项，单题拆出来会丢上下文，交给模型
+# 题型标题关键字 -> type，顺序与提示词里的归一化规则一致；「选择题」这类笼统标题按选项和答案推断
+TYPE_RULES = (("X型", "MULTI_CHOICE"), ("多选", "MULTI_CHOICE"), ("多项", "MULTI_CHOICE"),
+              ("不定项", "MULTI_CHOICE"), ("A1", "SINGLE_CHOICE"), ("A2", "SINGLE_CHOICE"),
+              ("B1", "SINGLE_CHOICE"), ("单选", "SINGLE_CHOICE"), ("单项", "SINGLE_CHOICE"),
+              ("填空", "FILL_BLANK"), ("判断", "TRUE_FALSE"), ("简答", "ESSAY"), ("名词解释", "ESSAY"),
+              ("病例", "ESSAY"), ("论述", "ESSAY"), ("计算", "ESSAY"))
+
+
+def header_type(header):
+    for word, qtype in TYPE_RULES:
+        if word in header: return qtype
+    return None
+
+
+def split_options(body):
+    """找出从 A 开始、字母连续的选项标签，返回 (题干, 选项列表)；不足两个选项视为没有选项"""
+    seq = []
+    for m in OPTION_LABEL.finditer(body):
+        if m.group(1) == chr(ord("A") + len(seq)):
+            seq.append(m)
+        elif m.group(1) == "A":
+            seq = [m]
+    if len(seq) < 2: return body, []
+    options = []
+    for k, m in enumerate(seq):
+        end = seq[k + 1].start() if k + 1 < len(seq) else len(body)
+        options.append({"label": m.group(1), "text": " ".join(body[m.end():end].split())})
+    return body[:seq[0].start()], options
+
+
+def cut_marks(body):
+    """从题目正文里切出 [答案] 和 [解析] 两段，返回 (正文, 答案, 解析)"""
+    marks = sorted((m.start(), m.end(), name) for name, m in
+                   (("answer", INLINE_ANSWER.search(body)), ("analysis", INLINE_ANALYSIS.search(body))) if m)
+    if not marks: return body, "", ""
+    found = {}
+    for i, (_, end, name) in enumerate(marks):
+        stop = marks[i + 1][0] if i + 1 < len(marks) else len(body)
+        found[name] = body[end:stop].strip()
+    return body[:marks[0][0]], found.get("answer", ""), found.get("analysis", "")
+
+
+def parse_block(header, block, answers):
+    """
+    解析一道题，返回 (题目, 置信度)；不是以题号开头的块返回 (None, 0)
+    置信度从 1 开始按可疑之处扣分：缺答案、答案字母不在选项里、单选给了多个答案、B1 共用选项等
+    """
+    m = QUESTION_START.match(block)
+    if not m: return None, 0.0
+    num = re.search(r'\d+', m.group(0)).group(0)
+    body, answer, analysis = cut_marks(block[m.end():])
+    stem, options = split_options(body)
+    stem = " ".join(stem.split())
+    if not stem: return None, 0.0
+    answer = answer or answers.get(num, "")
+
+    qtype, score = header_type(header), 1.0
+    letters = re.sub(r'[\s,，、;；]', '', answer).upper()
+    if qtype is None:
+        score -= 0.1
+        if options: qtype = "MULTI_CHOICE" if len(letters) > 1 else "SINGLE_CHOICE"
+        elif answer.upper() in TRUE_FALSE_ANSWERS: qtype = "TRUE_FALSE"
+        else: return None, 0.0
+    if qtype in ("SINGLE_CHOICE", "MULTI_CHOICE"):
+        labels = {o["label"] for o in options}
+        if len(options) < 2: score -= 0.5
+        if any(not o["text"] for o in options): score -= 0.3
+        if not answer: score -= 0.4
+        elif not CHOICE_LETTERS.match(letters) or set(letters) - labels: score -= 0.5
+        elif qtype == "SINGLE_CHOICE" and len(letters) > 1: score -= 0.3
+        else: answer = letters
+        if any(t in header for t in SHARED_TYPES): score -= 0.3
+    elif qtype == "TRUE_FALSE":
+        if answer.upper() not in TRUE_FALSE_ANSWERS: score -= 0.5
+    else:
+        # 填空/简答的答案是自由文本，边界只能靠标记判断，没有答案时交给模型
+        score -= 0.1 if answer else 0.5
+    if not header: score -= 0.1
+
+    # 「单项选择题」这类标题 normalize_category 认不出来，按题型取与模型一致的分类名
+    category = normalize_category(SECTION_ORDINAL.sub("", header)) if header else ""
+    if not category or "选择" in category: category = TYPE_CATEGORIES.get(qtype, category)
+    item = {"category": category, "type": qtype, "content": stem, "options": options,
+            "answer": answer, "analysis": analysis}
+    return item, round(score, 2)
+
+
+def local_extract(chunk, ans_key=""):
+    """
+    本地解析一个切片，逐块扫描一次，线性时间
+    返回 (本地解析出的 [(位置, 题目)], 需要交给模型的 [(位置, 标题, 块)])
+    """
+    if not LOCAL_EXTRACT: return [], [(0, "", chunk)]
+    answers = dict(KEY_ENTRY.findall(ans_key))
+    parsed, rest = [], []
+    for pos, (header, block) in enumerate(split_questions(chunk.split("\n"))):
+        item, confidence = parse_block(header, block, answers)
+        if item is not None and confidence >= LOCAL_MIN_CONFIDENCE:
+            parsed.append((pos, item))
+        elif item is not None or len(block.strip()) > 20:
+            # 不是题号开头的零碎短行 (页眉、说明) 直接丢弃，其余交给模型
+            rest.append((pos, header, block))
+    return parsed, rest
+
+
+def rest_text(rest):
+    """把需要交给模型的块重新拼成文本，标题变化处补上标题行"""
+    lines, last = [], None
+    for _, header, block in rest:
+        if header and header != last: lines.append(header)
+        last = header
+        lines.append(block)
+    return "\n".join(lines)
+
+
+def order_items(parsed, rest, items):
+    """按原文位置合并本地和模型提取的题目；模型的题目按题干定位所属块，定位不到的排在最后"""
+    if not parsed: return items
+    ranked = [(pos, i, item) for i, (pos, item) in enumerate(parsed)]
+    blocks = [(pos, normalize_text(block)) for pos, _, block in rest]
+    for i, item in enumerate(items):
+        anchor = normalize_text(str(item.get('content', '')))[:12]
+        pos = next((p for p, text in blocks if anchor and anchor in text), float("inf"))
+        ranked.append((pos, len(parsed) + i, item))
+    ranked.sort(key=lambda r: (r[0], r[1]))
+    return [item for _, _, item in ranked]
+
+
+class ArrayStreamParser:
+    """
+    增量解析模型输出的 JSON 数组：每收到一段文本就往后扫描，对象一闭合立即解析产出
+    - 跳过 ```json 之类的前缀，直到遇到 [ (或直接以 { 开头的单个对象)
+    - 某个对象解析失败即标记 broken，之前已解析的对象全部保留
+    - 已消费的文本随时丢弃，整体线性
+    """
 
-def process_chunk(args):
+    def __init__(self):
+        self.items = []
+        self.text = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_str = False
+        self.escape = False
+        self.obj_start = None
+        self.started = False
+        self.implicit = False
+        self.closed = False
+        self.broken = False
+        self.parse_time = 0.0
+
+    def feed(self, piece):
+        if self.closed or self.broken or not piece: return []
+        t0 = time.perf_counter()
+        self.text += piece
+        out = []
+        text, i = self.text, self.pos
+        while i < len(text):
+            c = text[i]
+            if not self.started:
+                if c == "[":
+                    self.started, self.depth = True, 1
+                elif c == "{":
+                    # 模型偶尔直接返回单个对象：当作只有一个元素的数组
+                    self.started, self.implicit, self.depth = True, True, 1
+                    continue
+            elif self.in_str:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_str = False
+            elif c == '"':
+                self.in_str = True
+            elif c in "{[":
+                self.depth += 1
+                if self.depth == 2 and c == "{": self.obj_start = i
+            elif c in "}]":
+                self.depth -= 1
+                if self.depth == 1 and c == "}" and self.obj_start is not None:
+                    try:
+                        obj = json.loads(text[self.obj_start:i + 1])
+                    except ValueError:
+                        self.broken = True
+                        break
+                    if isinstance(obj, dict):
+                        self.items.append(obj)
+                        out.append(obj)
+                    self.obj_start = None
+                elif self.depth <= 0:
+                    self.closed = True
+                    break
+            i += 1
+        # 丢掉已消费的前缀，只保留正在解析的对象
+        keep = self.obj_start if self.obj_start is not None else i
+        self.text, self.pos = text[keep:], i - keep
+        if self.obj_start is not None: self.obj_start = 0
+        self.parse_time += time.perf_counter() - t0
+        return out
+
+    def complete(self, finish_reason):
+        """数组正常闭合即完整；模型明确说没有题目 (没输出数组且不是被截断) 也算完整"""
+        if self.broken: return False
+        if self.closed: return True
+        ended = finish_reason not in ("length", None)
+        if self.implicit: return ended and self.depth == 1 and self.obj_start is None
+        return not self.started and ended
+
+
+def normalize_text(text):
+    # NFKC 归一化后去掉空白与标点，大小写不敏感
+    raw = unicodedata.normalize("NFKC", text).lower()
+    return "".join(ch for ch in raw if unicodedata.category(ch)[0] not in "PZC")
+
+
+def tail_after(text, last_q):
+    """
+    在切片原文中找到最后一道已成功解析的题目，返回它之后的剩余文本 (保留开头的题型标题)
+    找不到时返回 None，由调用方整段重试 (重复的题目在合并时去重)
+    """
+    anchor = normalize_text(str(last_q.get('content', '')))[:12]
+    if not anchor: return None
+    lines = text.split("\n")
+    header = lines[0] if lines and SECTION_HEADER.match(lines[0]) else ""
+    found = None
+    for i, line in enumerate(lines):
+        if anchor in normalize_text(line):
+            found = i
+            break
+    if found is None: return None
+    for j in range(found + 1, len(lines)):
+        if QUESTION_START.match(lines[j]):
+            rest = "\n".join(lines[j:])
+            return (header + "\n" + rest) if header else rest
+    return ""
+
+
+def settle_reply(parser, finish_reason, pending, collected):
     """
-    V17 核心逻辑：死磕模式 + 反侦察伪装
-    目标：100% 提取，且让 API 平台难以判定为恶意攻击
+    合并一次回复的结果，返回仍需重试的文本；None 表示切片已全部完成
+    回复不完整时只重试最后一道成功题目之后的部分
     """
-    chunk, idx, ans_key = args
+    collected.extend(parser.items)
+    if parser.complete(finish_reason): return None
+    if not parser.items: return pending
+    tail = tail_after(pending, parser.items[-1])
+    if tail is None: return pending
+    return tail if tail.strip() else None
+
+
+# ✂️ 截断拆分：回复被 max_tokens 截断时把剩余文本按题目边界拆开并发提取
+DOC_BUDGETS = {}  # 文档 -> 学习到的切片预算：被截断过的文档，后续切片一开始就按它拆好
+DOC_BUDGETS_LOCK = threading.Lock()
+
+
+def doc_of(job):
+    # 任务 id 形如 "文件名#序号"
+    return job.rsplit("#", 1)[0] if job else None
+
+
+def usage_tokens(usage):
+    """SDK 返回对象、SSE/HTTP 返回 dict，统一取 (prompt_tokens, completion_tokens)"""
+    if usage is None: return None, None
+    if isinstance(usage, dict): return usage.get("prompt_tokens"), usage.get("completion_tokens")
+    return getattr(usage, "prompt_tokens", None), getattr(usage, "completion_tokens", None)
+
+
+def finish_reason(finish, usage):
+    # finish_reason 缺失时，输出 token 数顶到 max_tokens 同样视为截断
+    tokens = usage_tokens(usage)[1]
+    if finish != "length" and tokens and tokens >= MAX_TOKENS: return "length"
+    return finish
+
+
+def split_text(text, budget):
+    """按题目边界把文本重新打包成不超过 budget tokens 的若干段 (单题拆不开时只有一段)"""
+    return [p for p in pack_chunks(text.split("\n"), budget) if p.strip()]
+
+
+def plan_parts(chunk, doc):
+    budget = DOC_BUDGETS.get(doc) if doc else None
+    if not budget or estimate_tokens(chunk) <= budget: return [chunk]
+    return split_text(chunk, budget)
+
+
+def learn_budget(doc, text):
+    """截断过的文本量的一半作为该文档的切片预算，只往小调"""
+    if not doc: return
+    budget = max(MIN_CHUNK_TOKENS, estimate_tokens(text) // 2)
+    with DOC_BUDGETS_LOCK:
+        if budget < DOC_BUDGETS.get(doc, CHUNK_TOKENS):
+            DOC_BUDGETS[doc] = budget
+            log_record(f"✂️ {doc} 输出被截断，后续切片按 {budget} tokens 预拆", "WARN")
 
-    # 🕵️‍♂️ 【伪装策略1】流量抖动
-    # 启动前随机休息，打破“并发齐射”的特征，模拟多人不同步操作
-    time.sleep(random.uniform(1.0, 4.0))
 
-    prompt = f"""
+def split_truncated(parser, finish, pending, collected, ctx, depth):
+    """
+    回复因 max_tokens 被截断时：收下已解析的题目，把剩余文本按题目边界对半拆开
+    返回待并发提取的各段 (空列表表示已无剩余)；不是截断或拆不开时返回 None，走普通重试
+    """
+    if finish != "length" or parser.complete(finish) or depth >= SPLIT_DEPTH: return None
+    rest = pending
+    if parser.items:
+        tail = tail_after(pending, parser.items[-1])
+        if tail is not None: rest = tail
+    if not rest.strip():
+        collected.extend(parser.items)
+        return []
+    parts = split_text(rest, estimate_tokens(rest) // 2 + 1)
+    if len(parts) < 2: return None
+    collected.extend(parser.items)
+    learn_budget(ctx["doc"], pending)
+    with ctx["lock"]:
+        ctx["splits"] += 1
+    return parts
+
+
+def merge_parts(results):
+    items = []
+    for data, err in results:
+        if err: return None, err
+        items.extend(data)
+    return items, None
+
+
+def build_prompt(chunk, ans_key):
+    return f"""
         [系统指令] 你是一个高并发、无状态的试题数据清洗引擎。
         [任务] 将输入的非结构化文本片段(Chunk)清洗并转换为严格的 JSON Array。
         [当前学科] {SUBJECT}
@@ -174,8 +827,8 @@ def process_chunk(args):
         2. **选项清洗**：移除选项前的 "A." "B." 或 "1)" 等标签，存入 "label"。
         3. **答案匹配**：优先提取题目自带的答案；若无，尝试在[参考答案库]中查找对应题号；无法确定则留空。
 
-        [参考答案库(仅供查找，非当前文本)]
-        {ans_key[:3000]}... (上下文截断)
+        [参考答案库(文档答案页中本片段题号对应的答案，仅供查找，非当前文本)]
+        {ans_key[:3000] or "无"}
 
         [One-Shot 示例(严格模仿此格式)]
         输入: "3. 高血压的诊断标准是( ) A. 140/90 B. 130/80 [答案]A [解析]见课本P10... 4. 糖尿病的典型"
@@ -198,66 +851,1149 @@ def process_chunk(args):
         {chunk}
         """
 
-    start_t = time.time()
+
+def log_retry(idx, attempt, kind, k_id, err):
+    # 连续失败才打印，让我们知道它在努力，但不要太频繁
+    if attempt > 3:
+        print(f"   🛡️ Chunk {idx + 1} 第{attempt}次失败 ({kind}, Key..{k_id}): {str(err)[:80]} | {RATE.snapshot()}",
+              flush=True)
+
+
+def process_chunk(args, submitted=None):
+    """
+    V17 核心逻辑：有限重试 + 自适应限流
+    目标：尽量 100% 提取，速度贴着配额走 —— 限流就降速换 Key，顺畅就逐步加并发
+    失败次数 (MAX_RETRIES) 或耗时 (CHUNK_TIME_BUDGET) 用尽就放弃，交给死信，不再卡死整轮
+    args: (切片, 序号, 答案库[, 任务 id])，任务 id 用于写切片任务日志
+    """
+    result, state = begin_chunk(args, submitted)
+    if result: return result
+    parts, ans_key, ctx = state["parts"], state["ans_key"], state["ctx"]
+    collected, err = [], None
+    if len(parts) == 1:
+        collected, err = extract_part(parts[0], ans_key, ctx)
+    elif parts:
+        collected, err = run_parts(parts, ans_key, ctx, 0)
+    return finish_chunk(state, collected, err)
+
+
+def begin_chunk(args, submitted):
+    """
+    process_chunk / process_chunk_async 共用的前半段：查缓存 → 续跑判死 → 本地解析
+    已有结论 (命中缓存 / 已判死) 时返回 (结果, None)；否则返回 (None, 状态)，状态里的 parts 是要交给模型的各段
+    """
+    chunk, idx, ans_key = args[:3]
+    job = args[3] if len(args) > 3 else None
+    started = time.time()
+
+    # 💾 先查缓存：内容没变就不必再花一次 API
+    cache = get_chunk_cache()
+    cache_key = chunk_cache_key(chunk, ans_key)
+    if cache:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            journal_mark(job, cache_key, "done")
+            record_chunk(job, idx, "cached", started, submitted, questions=len(cached))
+            return (cached, None, f"Chunk {idx + 1} 命中缓存"), None
+
+    # 📓 续跑：沿用上次已用掉的失败次数，已判死的切片直接交回死信
+    failures, dead = journal_resume(job, cache_key)
+    if dead:
+        record_chunk(job, idx, "dead", started, submitted)
+        return (None, f"Chunk {idx + 1} {dead}", ""), None
+    journal_mark(job, cache_key, "in-flight", failures)
+
+    ctx = new_context(idx, job, cache_key, failures)
+    parsed, rest = local_extract(chunk, ans_key)
+    ctx["local"] = len(parsed)
+    parts = plan_parts(rest_text(rest), ctx["doc"]) if rest else []
+    return None, {"ctx": ctx, "ans_key": ans_key, "cache": cache, "started": started, "submitted": submitted,
+                  "parsed": parsed, "rest": rest, "parts": parts}
+
+
+def finish_chunk(state, collected, err):
+    """process_chunk / process_chunk_async 共用的后半段：失败记任务日志交死信，成功写缓存"""
+    ctx, started, submitted = state["ctx"], state["started"], state["submitted"]
+    job, idx, cache_key = ctx["job"], ctx["idx"], ctx["key"]
+    if err:
+        journal_mark(job, cache_key, "failed", ctx["failures"], err)
+        record_chunk(job, idx, "failed", started, submitted, ctx)
+        return None, f"Chunk {idx + 1} {err}", ""
+
+    # 成功后写缓存并立即返回
+    collected = order_items(state["parsed"], state["rest"], collected)
+    if state["cache"]: state["cache"].put(cache_key, collected)
+    journal_mark(job, cache_key, "done", ctx["failures"])
+    record_chunk(job, idx, "done", started, submitted, ctx, len(collected))
+    return collected, None, done_message(ctx)
+
+
+def new_context(idx, job, cache_key, failures):
+    # 同一切片拆出的各段共用一份失败预算
+    return {"idx": idx, "job": job, "key": cache_key, "doc": doc_of(job), "failures": failures,
+            "start": time.time(), "retries": 0, "splits": 0, "local": 0, "k_id": "", "lock": threading.Lock()}
+
+
+def note_failure(ctx, kind):
+    with ctx["lock"]:
+        ctx["failures"] += 1
+        ctx["retries"] += 1
+        failures = ctx["failures"]
+    journal_mark(ctx["job"], ctx["key"], "in-flight", failures, kind)
+
+
+def exhausted_error(ctx):
+    if not budget_exhausted(ctx["failures"], ctx["start"]): return None
+    return f"重试耗尽 (失败 {ctx['failures']} 次, 耗时 {time.time() - ctx['start']:.0f}s)"
+
+
+def record_request(ctx, attempt, k_id, req_t, outcome, parser=None, usage=None):
+    prompt_tokens, completion_tokens = usage_tokens(usage)
+    METRICS.record("request", outcome, job=ctx["job"], attempt=attempt, key=k_id,
+                   latency=round(time.time() - req_t, 3), prompt_tokens=prompt_tokens,
+                   completion_tokens=completion_tokens, parse_time=round(parser.parse_time, 5) if parser else None)
+
+
+def record_chunk(job, idx, outcome, started, submitted, ctx=None, questions=0):
+    # queue_wait：从提交到引擎到真正开始处理的等待时间
+    METRICS.record("chunk", outcome, slow_by="total", job=job, idx=idx,
+                   queue_wait=round(started - submitted, 3) if submitted else None,
+                   total=round(time.time() - started, 3), retries=ctx["retries"] if ctx else 0,
+                   splits=ctx["splits"] if ctx else 0, local=ctx["local"] if ctx else 0, questions=questions)
+
+
+def done_message(ctx):
+    cost = time.time() - ctx["start"]
+    split = f", 拆分:{ctx['splits']}" if ctx["splits"] else ""
+    local = f", 本地:{ctx['local']}题" if ctx["local"] else ""
+    if not ctx["k_id"]: return f"Chunk {ctx['idx'] + 1} 本地解析完成 ({ctx['local']}题, 耗时:{cost * 1000:.1f}ms)"
+    return f"Chunk {ctx['idx'] + 1} 完成 (耗时:{cost:.1f}s, 重试:{ctx['retries']}{split}{local}, Key:..{ctx['k_id']})"
+
+
+def extract_part(text, ans_key, ctx, depth=0):
+    """
+    提取一段文本，返回 (题目列表, 错误信息)
+    回复被 max_tokens 截断时，收下已解析的题目，把剩余部分按题目边界拆开并发提取 (最多 SPLIT_DEPTH 层)
+    """
+    pending, collected = text, []
     attempt = 0
 
-    # ♾️ 死磕循环：只要不成功，就一直换号重试，直到天荒地老
+    # 🔁 重试循环：限流不计失败次数，其余错误计数，预算用尽即放弃
     while True:
         attempt += 1
+        err = exhausted_error(ctx)
+        if err: return None, err
 
-        # 🕵️‍♂️ 【伪装策略2】身份漫游
-        # 每次请求（包括重试）都切换不同的 Key
-        # 让平台认为这是该 IP 下的“另一个用户”在尝试
-        client, k_id = get_random_client()
-
+        # 🚦 由限流器分配 Key：令牌桶控制每个 Key 的频率，AIMD 控制总在途数；等待不超过切片剩余的耗时预算
         try:
-            # ⚡️ 强制超时：45秒
-            # 设置得比平台默认短，防止被判定为长连接占用资源
-            res = client.chat.completions.create(
-                model=AI_MODEL_NAME, messages=[{"role": "user", "content": prompt}],
-                temperature=0.1, top_p=0.7, max_tokens=4000, timeout=45
-            )
-            content = repair_json(res.choices[0].message.content)
-            data = json.loads(content)
+            key = RATE.acquire(ctx["start"] + CHUNK_TIME_BUDGET)
+        except NoKeyAvailable as e:
+            return None, str(e)
+        req_t = time.time()
+        parser = ArrayStreamParser()
+        try:
+            finish, usage = request_sync(get_client(key), build_prompt(pending, ans_key), parser)
+        except Exception as e:
+            kind, err = on_request_error(ctx, attempt, key, req_t, parser, e)
+            if err: return None, err
+            time.sleep(RATE.retry_delay(attempt, kind))
+            continue
+
+        step, rest = on_reply(ctx, attempt, key, req_t, parser, finish, usage, pending, collected, depth)
+        if step == "split":
+            if not rest: return collected, None
+            data, err = run_parts(rest, ans_key, ctx, depth + 1)
+            if err: return None, err
+            return collected + data, None
+        if step == "retry":
+            pending = rest
+            time.sleep(RATE.retry_delay(attempt, "parse"))
+            continue
+        return collected, None
+
+
+def on_request_error(ctx, attempt, key, req_t, parser, error):
+    """extract_part / extract_part_async 共用：请求出错时归还 Key 并记账，返回 (错误类别, 放弃时的错误信息)"""
+    kind = RATE.release(key, error=error)
+    record_request(ctx, attempt, key[-4:], req_t, kind, parser)
+    if kind == "fatal": return kind, f"请求被拒绝，不再重试: {error}"
+    if kind != "throttle": note_failure(ctx, kind)
+    log_retry(ctx["idx"], attempt, kind, key[-4:], error)
+    return kind, None
+
+
+def on_reply(ctx, attempt, key, req_t, parser, finish, usage, pending, collected, depth):
+    """
+    extract_part / extract_part_async 共用：拿到回复后归还 Key、记账，再决定下一步
+    返回 ("split", 各段) 截断后拆开提取 (空列表表示已无剩余) / ("retry", 剩余文本) 回复不完整 / ("done", None)
+    """
+    RATE.release(key, latency=time.time() - req_t)
+    k_id = ctx["k_id"] = key[-4:]
+    outcome = "ok" if parser.complete(finish) else "truncated" if finish == "length" else "parse"
+    record_request(ctx, attempt, k_id, req_t, outcome, parser, usage)
+
+    # ✂️ 输出被截断：剩余部分对半拆开并发提取
+    parts = split_truncated(parser, finish, pending, collected, ctx, depth)
+    if parts is not None: return "split", parts
+
+    pending = settle_reply(parser, finish, pending, collected)
+    if pending is not None:
+        # 回复不完整：保留已解析的题目，只重试剩余部分
+        note_failure(ctx, "parse")
+        log_retry(ctx["idx"], attempt, "parse", k_id, f"已解析 {len(collected)} 题，重试剩余 {len(pending)} 字")
+        return "retry", pending
+    return "done", None
+
+
+def request_sync(client, prompt, parser):
+    """发一次请求并把回复喂给 parser，返回 (finish_reason, usage)"""
+    res = client.chat.completions.create(
+        model=AI_MODEL_NAME, messages=[{"role": "user", "content": prompt}],
+        temperature=TEMPERATURE, top_p=TOP_P, max_tokens=MAX_TOKENS, timeout=REQUEST_TIMEOUT,
+        stream=STREAM
+    )
+    if not STREAM:
+        parser.feed(res.choices[0].message.content or "")
+        return finish_reason(res.choices[0].finish_reason, res.usage), res.usage
+
+    # 📡 流式：对象一闭合就解析，坏对象出现后不再等剩下的输出
+    finish, usage = None, None
+    for event in res:
+        usage = getattr(event, "usage", None) or usage
+        if not event.choices: continue
+        parser.feed(event.choices[0].delta.content or "")
+        finish = event.choices[0].finish_reason or finish
+        if parser.broken: break
+    return finish_reason(finish, usage), usage
+
+
+def run_parts(parts, ans_key, ctx, depth):
+    """
+    并发提取拆开的各段，按原顺序合并；任一段失败整体失败
+    每段一个线程 (真正的在途请求数仍由 RATE 控制)，不占用引擎线程池，嵌套拆分也不会互相等死
+    """
+    results = [None] * len(parts)
+
+    def work(i):
+        results[i] = extract_part(parts[i], ans_key, ctx, depth)
 
-            # 成功后立即返回
-            cost = time.time() - start_t
-            msg = f"Chunk {idx + 1} 完成 (耗时:{cost:.1f}s, 重试:{attempt - 1}, Key:..{k_id})"
+    threads = [threading.Thread(target=work, args=(i,), daemon=True) for i in range(1, len(parts))]
+    for t in threads: t.start()
+    work(0)
+    for t in threads: t.join()
+    return merge_parts(results)
 
-            if isinstance(data, list): return data, None, msg
-            if isinstance(data, dict): return [data], None, msg
 
-            # 数据格式不对，视为失败，抛出异常进入重试
-            raise ValueError("JSON格式解析失败")
+async def process_chunk_async(args, http, submitted=None):
+    """
+    process_chunk 的协程版：同样的缓存/重试/限流/拆分/任务日志策略，但等待不占线程
+    http 为长连接复用的 httpx.AsyncClient
+    """
+    result, state = begin_chunk(args, submitted)
+    if result: return result
+    parts, ans_key, ctx = state["parts"], state["ans_key"], state["ctx"]
+    collected, err = [], None
+    if len(parts) == 1:
+        collected, err = await extract_part_async(parts[0], ans_key, ctx, http)
+    elif parts:
+        collected, err = await run_parts_async(parts, ans_key, ctx, http, 0)
+    return finish_chunk(state, collected, err)
+
+
+async def extract_part_async(text, ans_key, ctx, http, depth=0):
+    """extract_part 的协程版"""
+    pending, collected = text, []
+    attempt = 0
+
+    while True:
+        attempt += 1
+        err = exhausted_error(ctx)
+        if err: return None, err
 
+        try:
+            key = await RATE.acquire_async(ctx["start"] + CHUNK_TIME_BUDGET)
+        except NoKeyAvailable as e:
+            return None, str(e)
+        req_t = time.time()
+        parser = ArrayStreamParser()
+        try:
+            finish, usage = await asyncio.wait_for(
+                request_async(http, key, build_prompt(pending, ans_key), parser), API_TIMEOUT)
+        except asyncio.CancelledError:
+            # 被取消 (引擎关闭 / 整轮中止) 不代表服务端状态：只归还名额，不算成功也不算失败
+            RATE.cancel(key)
+            raise
         except Exception as e:
-            # 🕵️‍♂️ 【伪装策略3】智能退避 (Smart Backoff)
-            # 失败了不要立即“疯狗式”重试，而是像人一样“愣一下”再试
+            kind, err = on_request_error(ctx, attempt, key, req_t, parser, e)
+            if err: return None, err
+            await asyncio.sleep(RATE.retry_delay(attempt, kind))
+            continue
+
+        step, rest = on_reply(ctx, attempt, key, req_t, parser, finish, usage, pending, collected, depth)
+        if step == "split":
+            if not rest: return collected, None
+            data, err = await run_parts_async(rest, ans_key, ctx, http, depth + 1)
+            if err: return None, err
+            return collected + data, None
+        if step == "retry":
+            pending = rest
+            await asyncio.sleep(RATE.retry_delay(attempt, "parse"))
+            continue
+        return collected, None
+
+
+async def request_async(http, key, prompt, parser):
+    """发一次请求并把回复喂给 parser，返回 (finish_reason, usage)；流式时按 SSE 逐段解析"""
+    payload = {"model": AI_MODEL_NAME, "messages": [{"role": "user", "content": prompt}],
+               "temperature": TEMPERATURE, "top_p": TOP_P, "max_tokens": MAX_TOKENS, "stream": STREAM}
+    headers = {"Authorization": f"Bearer {key}"}
+    if not STREAM:
+        res = await http.post("/chat/completions", headers=headers, json=payload)
+        res.raise_for_status()
+        body = res.json()
+        choice = body["choices"][0]
+        parser.feed(choice["message"].get("content") or "")
+        return finish_reason(choice.get("finish_reason"), body.get("usage")), body.get("usage")
+
+    finish, usage = None, None
+    async with http.stream("POST", "/chat/completions", headers=headers, json=payload) as res:
+        if res.status_code >= 400:
+            await res.aread()
+            res.raise_for_status()
+        async for line in res.aiter_lines():
+            if not line.startswith("data:"): continue
+            data = line[5:].strip()
+            if data == "[DONE]": break
+            event = json.loads(data)
+            usage = event.get("usage") or usage
+            choices = event.get("choices") or []
+            if not choices: continue
+            parser.feed((choices[0].get("delta") or {}).get("content") or "")
+            finish = choices[0].get("finish_reason") or finish
+            if parser.broken: break
+    return finish_reason(finish, usage), usage
+
+
+async def run_parts_async(parts, ans_key, ctx, http, depth):
+    results = await asyncio.gather(*(extract_part_async(p, ans_key, ctx, http, depth) for p in parts))
+    return merge_parts(results)
+
+
+# ================= ⚡ 执行引擎 =================
+class ThreadEngine:
+    """线程池引擎：每个切片占一个线程 (默认)，线程数按并发上限开，实际在途数由 RATE 决定"""
+
+    def __init__(self):
+        self.workers = MAX_CONCURRENCY
+
+    def __enter__(self):
+        self.exc = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+        return self
+
+    def submit(self, args):
+        return self.exc.submit(process_chunk, args, time.time())
+
+    def __exit__(self, *exc_info):
+        self.exc.shutdown(wait=True)
+
+
+class AsyncEngine:
+    """
+    asyncio 引擎：事件循环跑在独立线程里，单线程即可维持数百个在途请求
+    - httpx.AsyncClient 全程复用，keep-alive 连接池不再随每次重试重建
+    - 在途请求数同样由 RATE 控制，ASYNC_CONCURRENCY 只是上限
+    - submit() 返回 concurrent.futures.Future，与线程池引擎接口一致
+    - 退出时取消所有未完成的任务并关闭连接
+    """
+
+    def __init__(self):
+        self.workers = ASYNC_CONCURRENCY
+
+    def __enter__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        import httpx
+
+        async def setup():
+            limits = httpx.Limits(max_connections=ASYNC_CONCURRENCY, max_keepalive_connections=ASYNC_CONCURRENCY)
+            self.http = httpx.AsyncClient(base_url=ZHIPU_BASE_URL, limits=limits,
+                                          timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=10.0))
+
+        asyncio.run_coroutine_threadsafe(setup(), self.loop).result()
+        return self
+
+    def submit(self, args):
+        return asyncio.run_coroutine_threadsafe(process_chunk_async(args, self.http, time.time()), self.loop)
+
+    def __exit__(self, *exc_info):
+        async def teardown():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for t in tasks: t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.http.aclose()
+
+        asyncio.run_coroutine_threadsafe(teardown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def make_local_engine():
+    return AsyncEngine() if ENGINE == "async" else ThreadEngine()
+
+
+def make_engine():
+    return QueueEngine() if ENGINE == "queue" else make_local_engine()
+
+
+# ================= 🛰️ 分布式队列 =================
+class ChunkQueue:
+    """
+    SQLite 切片队列：放在共享卷上即可多机共用，本机多进程也能直接测试
+    每个切片一行，state: pending → leased (带租约，worker 定期续约) → done (结果 JSON)
+    - 租约过期 (worker 掉线) 的切片会被别的 worker 重新领取；领取超过 QUEUE_MAX_CLAIMS 次直接以失败结束，进死信
+    - 同一切片被重复处理时以先写回的结果为准 (切片处理是幂等的，重复的那次多半命中缓存)
+    - 协调进程在 runs 表里定期心跳；只领取心跳未过期的轮次，协调进程崩溃留下的切片在下次领取时清掉
+    每个线程一个连接，写操作都在 BEGIN IMMEDIATE 事务里，多进程并发领取不会拿到同一个切片
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self.tx() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS jobs (seq INTEGER PRIMARY KEY AUTOINCREMENT, run TEXT, "
+                       "payload TEXT, state TEXT, owner TEXT, lease_until REAL, claims INTEGER DEFAULT 0, result TEXT)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, seq)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_run ON jobs (run, state)")
+            db.execute("CREATE TABLE IF NOT EXISTS runs (run TEXT PRIMARY KEY, heartbeat REAL)")
+
+    def conn(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return db
+
+    @contextlib.contextmanager
+    def tx(self):
+        db = self.conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def register(self, run):
+        self.conn().execute("INSERT OR REPLACE INTO runs (run, heartbeat) VALUES (?, ?)", (run, time.time()))
+
+    def beat(self, run):
+        """续约一个轮次，返回 False 表示该轮次已被当作掉线清理"""
+        return self.conn().execute("UPDATE runs SET heartbeat = ? WHERE run = ?", (time.time(), run)).rowcount > 0
+
+    def purge(self, db, now):
+        # 心跳超过一个租约没更新的轮次视为协调进程已崩溃，连同切片一起删掉；没有登记的轮次同样处理
+        db.execute("DELETE FROM runs WHERE heartbeat < ?", (now - QUEUE_LEASE,))
+        db.execute("DELETE FROM jobs WHERE run NOT IN (SELECT run FROM runs)")
+
+    def publish(self, run, args):
+        """发布一个切片，返回序号 (协调进程按它排定合并顺序)"""
+        cur = self.conn().execute("INSERT INTO jobs (run, payload, state) VALUES (?, ?, 'pending')",
+                                  (run, json.dumps(list(args), ensure_ascii=False)))
+        return cur.lastrowid
+
+    def claim(self, owner, n):
+        """领取最多 n 个待处理或租约已过期的切片 (只限仍在心跳的轮次)，返回 [(序号, 参数)]"""
+        if n <= 0: return []
+        now, claimed = time.time(), []
+        with self.tx() as db:
+            self.purge(db, now)
+            rows = db.execute("SELECT seq, payload, claims FROM jobs WHERE (state = 'pending' "
+                              "OR (state = 'leased' AND lease_until < ?)) AND run IN (SELECT run FROM runs) "
+                              "ORDER BY seq LIMIT ?", (now, n)).fetchall()
+            for seq, payload, claims in rows:
+                if claims >= QUEUE_MAX_CLAIMS:
+                    err = f"租约过期 {claims} 次 (worker 掉线)，放弃"
+                    db.execute("UPDATE jobs SET state = 'done', result = ? WHERE seq = ?",
+                               (json.dumps([None, err, ""]), seq))
+                    continue
+                db.execute("UPDATE jobs SET state = 'leased', owner = ?, lease_until = ?, claims = claims + 1 "
+                           "WHERE seq = ?", (owner, now + QUEUE_LEASE, seq))
+                claimed.append((seq, json.loads(payload)))
+        return claimed
+
+    def heartbeat(self, owner, seqs):
+        if not seqs: return
+        marks = ",".join("?" * len(seqs))
+        self.conn().execute(f"UPDATE jobs SET lease_until = ? WHERE owner = ? AND state = 'leased' AND seq IN ({marks})",
+                            [time.time() + QUEUE_LEASE, owner] + list(seqs))
+
+    def complete(self, seq, result):
+        self.conn().execute("UPDATE jobs SET state = 'done', result = ? WHERE seq = ? AND state != 'done'",
+                            (json.dumps(result, ensure_ascii=False), seq))
+
+    def collect(self, run):
+        """取走本轮已完成的结果 (取走即删除)，返回 [(序号, 结果)]"""
+        with self.tx() as db:
+            rows = db.execute("SELECT seq, result FROM jobs WHERE run = ? AND state = 'done'", (run,)).fetchall()
+            if rows: db.execute("DELETE FROM jobs WHERE run = ? AND state = 'done'", (run,))
+        return [(seq, json.loads(result)) for seq, result in rows]
+
+    def drop(self, run):
+        with self.tx() as db:
+            db.execute("DELETE FROM jobs WHERE run = ?", (run,))
+            db.execute("DELETE FROM runs WHERE run = ?", (run,))
+
+
+def run_worker(chunk_queue, engine, owner, stop, idle_exit=0, verbose=False):
+    """
+    领取 → 交给本机引擎处理 → 写回，直到 stop 被置位或空闲超过 idle_exit 秒；返回处理的切片数
+    只比限流器当前的并发上限多领一个，慢的机器不会囤积切片；每 1/3 租约给在途切片续一次约
+    队列库暂时不可用 (锁等待超时、共享卷 I/O 错误) 时退避重试；算完的结果先留在本地，写回成功才算交付
+    """
+    inflight, finished, unsent = {}, queue.Queue(), []  # 序号 -> 任务 id / 完成的 future / 待写回的 (序号, 结果)
+    beat = idle_since = time.time()
+    count = errors = 0
+    while not stop.is_set():
+        try:
+            room = min(engine.workers, int(RATE.snapshot()["limit"]) + 1) - len(inflight)
+            claimed = chunk_queue.claim(owner, room)
+            for seq, args in claimed:
+                inflight[seq] = args[3] if len(args) > 3 else seq
+                engine.submit(tuple(args)).add_done_callback(lambda fut, seq=seq: finished.put((seq, fut)))
+
+            try:
+                while True:
+                    seq, fut = finished.get(timeout=QUEUE_POLL) if not unsent else finished.get_nowait()
+                    try:
+                        unsent.append((seq, list(fut.result())))
+                    except Exception as e:
+                        unsent.append((seq, [None, str(e), ""]))
+            except queue.Empty:
+                pass
+            while unsent:
+                seq, result = unsent[0]
+                chunk_queue.complete(seq, result)
+                unsent.pop(0)
+                job = inflight.pop(seq)
+                count += 1
+                if verbose: log_record(f"[{job}] {result[2] or result[1]}", "ERROR" if result[1] else "INFO")
+
+            now = time.time()
+            if inflight and now - beat > QUEUE_LEASE / 3:
+                chunk_queue.heartbeat(owner, inflight)
+                beat = now
+            errors = 0
+        except (sqlite3.Error, OSError) as e:
+            errors += 1
+            delay = min(QUEUE_LEASE / 3, QUEUE_POLL * 2 ** errors)
+            log_record(f"🛰️ 队列库访问失败 (连续 {errors} 次)，{delay:.1f}s 后重试: {e}", "WARN")
+            stop.wait(delay)
+            continue
+        if claimed or inflight:
+            idle_since = now
+        elif idle_exit and now - idle_since > idle_exit:
+            break
+    return count
+
+
+class QueueEngine:
+    """
+    分布式引擎 (engine = "queue")：切片发布到共享队列，由任意台机器上的 --worker 进程领取处理
+    - submit() 立即返回 Future，结果严格按发布顺序交回：多机并行时合并、去重、编号的顺序依然确定
+    - 协调进程自己也跑一个 worker (QUEUE_LOCAL_WORKER)，没有其他机器时与 thread 引擎一样能独立完成
+    - 退出时删除本轮残留的切片，worker 不会再领到
+    - 轮次被清理 (心跳超时) 或队列库连续访问失败时，未完成的切片全部以失败交回；之后的 submit 换一个新轮次继续，
+      --watch 复用同一个引擎时下一轮不受影响
+    """
+
+    def __init__(self):
+        self.workers = QUEUE_WINDOW
+
+    def __enter__(self):
+        self.queue = ChunkQueue(QUEUE_DB)
+        self.order = collections.deque()  # [(序号, future)]，按发布顺序
+        self.ready = {}  # 序号 -> 已取回但还没轮到的结果
+        self.lock = threading.Lock()
+        self.new_run()
+        self.stop = threading.Event()
+        self.poller = threading.Thread(target=self.poll, daemon=True)
+        self.poller.start()
+        self.local = None
+        if QUEUE_LOCAL_WORKER:
+            self.local = make_local_engine().__enter__()
+            owner = f"{socket.gethostname()}-{os.getpid()}-local"
+            self.local_worker = threading.Thread(target=run_worker, daemon=True,
+                                                 args=(ChunkQueue(QUEUE_DB), self.local, owner, self.stop))
+            self.local_worker.start()
+        return self
+
+    def new_run(self):
+        # 先登记再发布，否则 worker 会把切片当作掉线轮次的残留清掉
+        run = uuid.uuid4().hex
+        self.queue.register(run)
+        self.run, self.dead = run, None  # dead：本轮次作废的原因
+
+    def submit(self, args):
+        fut = concurrent.futures.Future()
+        with self.lock:
+            if self.dead: self.new_run()
+            self.order.append((self.queue.publish(self.run, args), fut))
+        return fut
+
+    def poll(self):
+        beat, errors = time.time(), 0
+        while not self.stop.is_set():
+            try:
+                if not self.dead and time.time() - beat > QUEUE_LEASE / 3:
+                    beat = time.time()
+                    if not self.queue.beat(self.run): self.fail("协调进程心跳超时，队列中的切片已被清理")
+                rows = self.queue.collect(self.run)
+                errors = 0
+            except (sqlite3.Error, OSError) as e:
+                errors += 1
+                log_record(f"🛰️ 队列库访问失败 (连续 {errors} 次): {e}", "WARN")
+                if errors >= QUEUE_MAX_ERRORS:
+                    self.fail(f"队列库连续 {errors} 次访问失败: {e}")
+                    errors = 0
+                self.stop.wait(min(QUEUE_LEASE / 3, QUEUE_POLL * 2 ** errors))
+                continue
+            with self.lock:
+                self.ready.update(rows)
+                while self.order and self.order[0][0] in self.ready:
+                    seq, fut = self.order.popleft()
+                    fut.set_result(tuple(self.ready.pop(seq)))
+            if not rows: self.stop.wait(QUEUE_POLL)
+
+    def fail(self, err):
+        # 本轮的结果不会再来了：未完成的切片全部以失败交回，由主线程转入死信
+        with self.lock:
+            self.dead = err
+            self.ready.clear()
+            while self.order:
+                self.order.popleft()[1].set_exception(RuntimeError(err))
+
+    def __exit__(self, *exc_info):
+        self.stop.set()
+        self.poller.join()
+        if self.local:
+            self.local_worker.join()
+            self.local.__exit__(*exc_info)
+        with self.lock:
+            for _, fut in self.order: fut.cancel()
+        self.queue.drop(self.run)
+
+
+# ================= 📓 切片任务日志 =================
+class JobJournal:
+    """
+    追加写的切片状态日志：每行 {"job", "key", "state", "attempts", "error"}，同一 job 以最后一行为准
+    state: pending / in-flight / done / failed
+    放在缓存目录 (与切片缓存一起跨运行保留)，进程崩溃后重启即可续跑：
+    done 的切片直接命中缓存，failed 的直接进死信，其余从已用掉的失败次数继续
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.jobs = {}
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b"\n"): break
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.jobs[rec["job"]] = rec
+        self.fp = open(path, 'a', encoding='utf-8')
+
+    def get(self, job, key):
+        rec = self.jobs.get(job)
+        # 切片内容变了 (文件改过)，旧记录作废
+        return rec if rec and rec.get("key") == key else None
+
+    def mark(self, job, key, state, attempts=0, error=None):
+        rec = {"job": job, "key": key, "state": state, "attempts": attempts, "error": error}
+        with self.lock:
+            self.jobs[job] = rec
+            self.fp.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self.fp.flush()
+
+    def clear(self):
+        # 整轮正常结束：结果都已进 manifest / 死信，日志不再需要
+        with self.lock:
+            self.fp.close()
+            self.jobs = {}
+            os.remove(self.path)
+
+
+JOURNAL = None
+
+
+def journal_mark(job, key, state, attempts=0, error=None):
+    if JOURNAL and job: JOURNAL.mark(job, key, state, attempts, error)
+
+
+def journal_resume(job, key):
+    """返回 (已用掉的失败次数, 已判死的错误信息)"""
+    rec = JOURNAL.get(job, key) if JOURNAL and job else None
+    if not rec: return 0, None
+    if rec["state"] == "failed": return rec["attempts"], rec.get("error") or "已进入死信"
+    return rec["attempts"], None
+
+
+def budget_exhausted(failures, start_t):
+    return failures >= MAX_RETRIES or time.time() - start_t > CHUNK_TIME_BUDGET
+
+
+def load_dead_letters():
+    if not os.path.exists(DEAD_LETTER_FILE): return []
+    try:
+        with open(DEAD_LETTER_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def drop_dead_letter(dead_letters, fname, idx):
+    """切片后来成功了 (重跑 / 重放)，就从死信里去掉它的旧记录；按 文件名 + 切片序号 匹配，返回是否有改动"""
+    kept = [d for d in dead_letters if d["file"] != fname or d["idx"] != idx]
+    if len(kept) == len(dead_letters): return False
+    dead_letters[:] = kept
+    return True
+
+
+# ================= 🧬 题目去重 =================
+DEDUP_MIN_STEM = 8  # 前缀判定时较短题干的最少字数，太短的题干不做近似匹配
+
+
+def question_text(q):
+    # 题干 + 选项，归一化后用于比较
+    parts = [str(q.get('content', ''))]
+    for opt in q.get('options') or []:
+        parts.append(str(opt.get('text', '')) if isinstance(opt, dict) else str(opt))
+    return normalize_text("".join(parts))
+
+
+def normalized_options(q):
+    return normalize_text("".join(str(o.get('text', '')) if isinstance(o, dict) else str(o)
+                                  for o in q.get('options') or []))
+
+
+def question_score(q):
+    # 记录越完整分越高：有答案 > 有解析 > 选项多 > 题干长
+    return (bool(str(q.get('answer', '')).strip()), bool(str(q.get('analysis', '')).strip()),
+            len(q.get('options') or []), len(str(q.get('content', ''))))
+
+
+def is_prefix_pair(a, b):
+    short, long_ = (a, b) if len(a) <= len(b) else (b, a)
+    return long_.startswith(short)
+
+
+def same_question(a, b):
+    """
+    近似重复的确认：题干归一化后相同，或较短的是较长的前缀 (截断后重试补回的尾巴)
+    选项同理 (截断的那条可能缺选项)；只看签名相似度会误杀「正确/错误」「成人/儿童」这类真题
+    """
+    if a["stem"] != b["stem"]:
+        if min(len(a["stem"]), len(b["stem"])) < DEDUP_MIN_STEM or not is_prefix_pair(a["stem"], b["stem"]):
+            return False
+    return is_prefix_pair(a["options"], b["options"])
+
+
+class DedupIndex:
+    """
+    合并结果时的去重索引 (按文档维护)：
+    - 精确重复：题干 + 选项归一化后的哈希直接命中，不论来自哪个切片
+    - 近似重复：只在同一切片 (截断重试的尾巴) 和相邻切片里找，并用 same_question 比对题干确认
+      试卷里本来就有大量形近题，跨切片的模糊匹配只会误删
+    add() 返回 (是否保留新题, 被替换掉的旧题 id)
+    """
+
+    def __init__(self):
+        self.exact = {}  # 归一化文本哈希 -> 记录
+        self.by_chunk = {}  # 切片序号 -> [记录]
+        self.dropped = 0
+
+    def add(self, q, idx=None):
+        text = question_text(q)
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        entry = {"id": q['id'], "score": question_score(q), "stem": normalize_text(str(q.get('content', ''))),
+                 "options": normalized_options(q)}
+
+        old = self.exact.get(digest)
+        if old is None and idx is not None:
+            for near in (idx, idx - 1, idx + 1):
+                old = next((c for c in self.by_chunk.get(near, ()) if same_question(entry, c)), None)
+                if old is not None: break
+
+        if old is not None:
+            self.dropped += 1
+            if entry["score"] <= old["score"]: return False, None
+            # 新记录更完整：接管旧记录在索引中的位置
+            replaced, old["id"], old["score"] = old["id"], entry["id"], entry["score"]
+            return True, replaced
+
+        self.exact[digest] = entry
+        if idx is not None: self.by_chunk.setdefault(idx, []).append(entry)
+        return True, None
+
+
+# ================= 📒 增量清单 =================
+def atomic_write_json(path, obj, indent=None):
+    # 先写临时文件再 os.replace，保证读到的永远是完整文件
+    with atomic_open(path, 'w', 'utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, indent=indent)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_manifest():
+    """
+    manifest 结构：
+    {"target": "output/outputN.json", "files": {文件名: {"sha256", "size", "mtime", "ids": [...]}}}
+    target 为空表示下次运行要新开一个 output{N}.json
+    """
+    if os.path.exists(MANIFEST_FILE):
+        try:
+            with open(MANIFEST_FILE, 'r', encoding='utf-8') as f:
+                m = json.load(f)
+            if isinstance(m.get("files"), dict): return m
+        except (OSError, ValueError):
+            log_record("manifest 损坏，按全量模式重新生成", "WARN")
+    return {"target": None, "files": {}}
+
+
+def diff_inputs(files, manifest):
+    """
+    对比 input/ 与 manifest，返回 (需要重新处理的文件, 已删除的文件, 最新指纹)
+    size+mtime 都没变时直接跳过哈希；git checkout 会刷新 mtime，所以最终以内容哈希为准
+    """
+    known = manifest["files"]
+    changed, fingerprints = [], {}
+    for fname in files:
+        path = os.path.join(INPUT_DIR, fname)
+        st = os.stat(path)
+        old = known.get(fname)
+        if old and old.get("size") == st.st_size and old.get("mtime") == st.st_mtime:
+            fingerprints[fname] = {"sha256": old["sha256"], "size": st.st_size, "mtime": st.st_mtime}
+            continue
+        digest = file_sha256(path)
+        fingerprints[fname] = {"sha256": digest, "size": st.st_size, "mtime": st.st_mtime}
+        if not old or old.get("sha256") != digest:
+            changed.append(fname)
+    deleted = [f for f in known if f not in fingerprints]
+    return changed, deleted, fingerprints
+
+
+OUTPUT_NAME = re.compile(r'^output(\d+)(?:\.json|\.ndjson)?$')
 
-            # 基础等待：2~5秒随机
-            wait_time = random.uniform(2.0, 5.0)
 
-            # 如果连续失败超过 3 次，说明可能被风控了，大幅增加休息时间
-            if attempt > 3:
-                wait_time = random.uniform(5.0, 10.0)
-                # 打印日志让我们知道它在努力，但不要太频繁
-                print(
-                    f"   🛡️ Chunk {idx + 1} 触发避险机制 (第{attempt}次重试) -> 切换身份(Key..{k_id}) -> 静默 {wait_time:.1f}s",
-                    flush=True)
+def next_output_file():
+    # 单文件 outputN.json 和分片目录 outputN/ 共用编号
+    used = [int(m.group(1)) for m in map(OUTPUT_NAME.match, os.listdir(OUTPUT_DIR)) if m]
+    return os.path.join(OUTPUT_DIR, f"output{max(used, default=0) + 1}.json")
 
-            # 如果连续失败超过 10 次，说明 IP 被暂时关小黑屋了，休息 20 秒
-            if attempt > 10:
-                wait_time = 20.0
 
-            time.sleep(wait_time)
+def bank_exists(target_file):
+    # 还没压实过的题库只有 NDJSON 日志 (上次运行在第一个文件提交前就中断了)，同样沿用
+    return any(os.path.exists(p) for p in (target_file, shards.index_path(target_file),
+                                            os.path.splitext(target_file)[0] + ".ndjson"))
+
+
+def bank_path(target_file):
+    # 交给 validator / 报告的题库入口：分片模式下是索引文件
+    return shards.index_path(target_file) if OUTPUT_LAYOUT == "sharded" else target_file
+
+
+# ================= 📦 流式输出 =================
+class QuestionSink:
+    """
+    追加写的题目日志 output/outputN.ndjson，每个切片完成后写入一次并 fsync
+    - manifest 是提交点：只有 manifest 里登记过 id 的题目才算有效，崩溃残留/已下线的题目在压实时丢弃
+    - 进程被杀最多留下半行，重新打开时截掉
+    - compact() 流式生成旧版 {"version","subject","data"} JSON，原子替换；分片模式下改写 outputN/ 分片与索引
+    """
+
+    def __init__(self, target_file):
+        self.target_file = target_file
+        self.index_file = shards.index_path(target_file)
+        self.sharded = OUTPUT_LAYOUT == "sharded"
+        self.log_file = os.path.splitext(target_file)[0] + ".ndjson"
+        self.lock = threading.Lock()
+        if self._needs_seed():
+            self._seed()
+        self._truncate_partial_line()
+        self.fp = open(self.log_file, 'ab')
+
+    def _snapshot(self):
+        # 上次压实的产物；切换 output_layout 后的第一轮从旧布局接续
+        paths = (self.index_file, self.target_file) if self.sharded else (self.target_file, self.index_file)
+        return next((p for p in paths if os.path.exists(p)), None)
+
+    def _needs_seed(self):
+        # 日志不在或比 JSON 旧 (CI 每次全新 checkout / validator 改过 JSON)，以 JSON 为准重建
+        snapshot = self._snapshot()
+        if not snapshot: return not os.path.exists(self.log_file)
+        if not os.path.exists(self.log_file): return True
+        return os.path.getmtime(snapshot) > os.path.getmtime(self.log_file)
+
+    def _seed(self):
+        qs, snapshot = [], self._snapshot()
+        if snapshot == self.index_file:
+            qs = shards.iter_questions(snapshot)
+        elif snapshot:
+            with open(snapshot, 'r', encoding='utf-8') as f:
+                qs = json.load(f).get("data", [])
+        with atomic_open(self.log_file) as f:
+            for q in qs:
+                f.write(json.dumps(q, ensure_ascii=False).encode('utf-8') + b"\n")
+
+    def _head(self, mark=None):
+        """压实后的头部：version / subject 用当前值，上次题库里的其余字段 (如 validator 写的 source) 原样保留"""
+        head, old, snapshot = {"version": OUTPUT_VERSION, "subject": SUBJECT}, {}, self._snapshot()
+        if snapshot == self.index_file:
+            old = shards.index_head(shards.load_index(snapshot))
+        elif snapshot:
+            with open(snapshot, 'r', encoding='utf-8') as f:
+                old = json.load(f)
+            old.pop("data", None)
+        for k, v in old.items():
+            head.setdefault(k, v)
+        if mark: mark(head)
+        return head
+
+    def _truncate_partial_line(self):
+        with open(self.log_file, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0: return
+            pos = size
+            while pos > 0:
+                step = min(4096, pos)
+                f.seek(pos - step)
+                block = f.read(step)
+                nl = block.rfind(b"\n")
+                if nl != -1:
+                    pos = pos - step + nl + 1
+                    break
+                pos -= step
+            if pos != size: f.truncate(pos)
+
+    def append(self, questions):
+        if not questions: return
+        payload = b"".join(json.dumps(q, ensure_ascii=False).encode('utf-8') + b"\n" for q in questions)
+        with self.lock:
+            self.fp.write(payload)
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+
+    def iter_live(self, live_ids):
+        """按 live_ids 的顺序 (manifest 里的文件顺序、切片顺序) 读出有效题目，与切片完成的先后无关"""
+        rank = {qid: n for n, qid in enumerate(live_ids)}
+        offsets, pos = {}, 0
+        with open(self.log_file, 'rb') as f:
+            # 第一遍只记每个 id 第一条记录的偏移，第二遍按顺序 seek 读出，内存里不放题目
+            for line in f:
+                if not line.endswith(b"\n"): break
+                qid = json.loads(line).get('id')
+                if qid in rank and qid not in offsets: offsets[qid] = pos
+                pos += len(line)
+            for qid in sorted(offsets, key=rank.get):
+                f.seek(offsets[qid])
+                yield json.loads(f.readline())
+
+    def compact(self, live_ids, mark=None):
+        """按 manifest 的有效 id (有序列表) 重写日志与旧版 JSON，返回题目总数；mark 为改写头部的回调 (融合校验标记 source)"""
+        if self.sharded: return self._compact_sharded(live_ids, mark)
+        head = self._head(mark)
+        self.fp.close()
+        count = 0
+        try:
+            # 先换 JSON 再换日志 (with 按相反顺序退出)：日志更新更晚，下次运行无需从 JSON 重建
+            with atomic_open(self.log_file) as fl, atomic_open(self.target_file, 'w', 'utf-8') as fj:
+                head = json.dumps(head, ensure_ascii=False, indent=2)
+                fj.write(head[:-2] + ',\n  "data": [')
+                for q in self.iter_live(live_ids):
+                    count += 1
+                    q['number'] = count
+                    fl.write(json.dumps(q, ensure_ascii=False).encode('utf-8') + b"\n")
+                    body = json.dumps(q, ensure_ascii=False, indent=2).replace("\n", "\n    ")
+                    fj.write(("\n    " if count == 1 else ",\n    ") + body)
+                fj.write("\n  ]\n}" if count else "]\n}")
+        finally:
+            self.fp = open(self.log_file, 'ab')
+        return count
+
+    def _compact_sharded(self, live_ids, mark=None):
+        """按章节分组后编号，重写日志与分片 + 索引；题号按分片顺序连续，逐片读出即为原顺序"""
+        chapters = {}
+        for q in self.iter_live(live_ids):
+            chapters.setdefault(q.get('chapter', ""), []).append(q)
+        count = 0
+        for qs in chapters.values():
+            for q in qs:
+                count += 1
+                q['number'] = count
+        head = self._head(mark)
+        self.fp.close()
+        try:
+            # 日志在分片与索引提交之后才替换
+            with atomic_open(self.log_file) as f:
+                for qs in chapters.values():
+                    for q in qs: f.write(json.dumps(q, ensure_ascii=False).encode('utf-8') + b"\n")
+                shards.write_bank(self.target_file, head, list(chapters.items()), OUTPUT_GZIP)
+        finally:
+            self.fp = open(self.log_file, 'ab')
+        return count
+
+    def close(self):
+        self.fp.close()
+
+
+# ================= 🔍 融合校验 =================
+class ValidationStage:
+    """
+    融合模式：切片抽出的题目先进校验队列，和后续切片的抽取并行进行
+    - 与抽取共用同一个 RATE：Key、令牌桶、AIMD 并发上限只有一份，两个阶段自动分摊配额
+    - 复用 validator 的规则预检、结论缓存与批量校验，结论写进 analysis 之后才追加到输出
+    - 结果交回主线程的 results 队列：("validated", 文件名, 题目列表)；校验出错也照常交回，题目不丢
+    """
+
+    def __init__(self):
+        import validator
+        validator.RATE = RATE
+        self.v = validator
+        self.store = validator.VerdictStore(validator.VERDICT_FILE, validator.VERDICT_MAX)
+        self.pool = ThreadPoolExecutor(max_workers=validator.MAX_WORKERS)
+        self.stats = {"validated": 0, "doubts": 0, "verdict_cached": 0, "rule_flagged": 0, "validate_errors": 0}
+        self.lock = threading.Lock()
+        validator.METRICS.reset()
+        try:
+            validator.METRICS.open(os.path.join(METRICS_DIR, "validator.ndjson"))
+        except OSError:
+            pass
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def apply(self, q, fp, is_doubt, reason):
+        with self.lock:
+            self.store.put(fp, is_doubt, reason)
+        analysis = self.v.strip_doubt(q.get('analysis', ""))
+        if is_doubt:
+            self.count("doubts")
+            analysis = reason + analysis
+        q['analysis'] = analysis
+
+    def validate(self, qs):
+        """同步校验一组题目 (原地改写 analysis)：规则预检 → 结论缓存 → 剩下的送 LLM"""
+        v, todo, fps = self.v, [], {}
+        for i, q in enumerate(qs):
+            problem = v.precheck(q)
+            if problem:
+                self.count("rule_flagged")
+                self.count("doubts")
+                q['analysis'] = v.rule_reason(problem) + v.strip_doubt(q.get('analysis', ""))
+                continue
+            fps[i] = v.question_fingerprint(q)
+            with self.lock:
+                hit = self.store.get(fps[i])
+            if hit is None:
+                todo.append((i, q))
+            else:
+                self.count("verdict_cached")
+                self.apply(q, fps[i], hit[0], hit[1])
+
+        results = {}
+        if v.VALIDATE_MODE == "single":
+            for i, q in todo: results[i] = v.validate_single(q)
+        else:
+            for batch in v.make_batches(todo): results.update(v.validate_batch(batch))
+        for i, (is_doubt, reason, err) in results.items():
+            if err:
+                self.count("validate_errors")
+                continue
+            self.apply(qs[i], fps[i], is_doubt, reason)
+        self.count("validated", len(qs))
+        return qs
+
+    def submit(self, fname, qs, results):
+        def run():
+            try:
+                self.validate(qs)
+            except Exception as e:
+                self.count("validate_errors")
+                log_record(f"[{fname}] 校验异常，题目按未校验写入: {e}", "WARN")
+            finally:
+                results.put(("validated", fname, qs))
+
+        self.pool.submit(run)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.store.save()
+        try:
+            self.v.METRICS.write_prometheus(os.path.join(METRICS_DIR, "validator.prom"))
+        except OSError as e:
+            log_record(f"校验指标导出失败: {e}", "WARN")
+        self.v.METRICS.close()
+        return self.stats
 
 
 # ================= 📤 发送模块 =================
+def metrics_html(summary, slowest):
+    """性能摘要 (直方图估算的分位数) + 最慢的 N 个切片"""
+    req, chunk = summary.get("request", {}), summary.get("chunk", {})
+    if not req and not chunk: return ""
+    rf, cf = req.get("fields", {}), chunk.get("fields", {})
+    lat, wait = rf.get("latency", {}), cf.get("queue_wait", {})
+    outcomes = " / ".join(f"{k} {v}" for k, v in sorted(req.get("outcomes", {}).items()))
+    rows = "".join(
+        f"<tr><td>{e.get('job') or e.get('idx')}</td><td>{e['total']:.1f}s</td><td>{e.get('retries', 0)}</td>"
+        f"<td>{e.get('splits', 0)}</td><td>{e.get('questions', 0)}</td><td>{e['outcome']}</td></tr>" for e in slowest)
+    table = f"""<table style="width:100%; font-size:12px; border-collapse:collapse;"><tr style="text-align:left; color:#666;"><th>切片</th><th>耗时</th><th>重试</th><th>拆分</th><th>题数</th><th>结果</th></tr>{rows}</table>""" if rows else ""
+    return f"""
+        <div style="background:#f8f9fa; padding:10px; border-radius:4px; margin-bottom:15px; font-size:13px;">
+            <h4 style="margin-top:0;">📈 性能</h4>
+            <p><b>请求:</b> {req.get('count', 0)} 次 ({outcomes or '-'})</p>
+            <p><b>请求延迟:</b> p50 {lat.get('p50', 0):.2f}s / p95 {lat.get('p95', 0):.2f}s / p99 {lat.get('p99', 0):.2f}s</p>
+            <p><b>排队等待:</b> p50 {wait.get('p50', 0):.2f}s / p95 {wait.get('p95', 0):.2f}s</p>
+            <p><b>Tokens:</b> 输入 {int(rf.get('prompt_tokens', {}).get('sum', 0))} / 输出 {int(rf.get('completion_tokens', {}).get('sum', 0))}</p>
+            <p><b>解析耗时:</b> {rf.get('parse_time', {}).get('sum', 0):.2f}s</p>
+            {table}
+        </div>"""
+
+
 def generate_html_report(data):
-    is_success = data['failed_chunks'] == 0
+    is_success = data['failed_chunks'] == 0 and not data.get('parse_errors')
     color = "#28a745" if is_success else "#dc3545"
     title = f"✅ {SUBJECT} 题库生成成功" if is_success else f"⚠️ {SUBJECT} 生成含异常"
-    log_html = "".join(EXECUTION_LOGS)
+    log_html = "".join(
+        f"<div style='color:{'red' if level == 'ERROR' else '#d35400'}; border-bottom:1px dashed #eee; padding:4px 0;'>[{ts}] {msg}</div>"
+        for ts, level, msg in EXECUTION_LOGS)
+    if log_html:
+        log_html = f"""<h4 style="margin:10px 0;">⚠️ 告警与错误</h4>
+        <div style="background:#fafafa; border:1px solid #eee; max-height:300px; overflow-y:auto; padding:10px; font-size:12px;">{log_html}</div>"""
+    validate_html = ""
+    if 'validated' in data:
+        validate_html = f"<p><b>🔍 校验:</b> {data['validated']} 题，存疑 {data['doubts']} 题，失败 {data['validate_errors']} 题</p>"
+    parse_html = ""
+    if data.get('parse_errors'):
+        items = "".join(f"<li>{e}</li>" for e in data['parse_errors'][:20])
+        parse_html = f"""<div style="background:#f8d7da; padding:10px; border-radius:4px; border:1px solid #f5c6cb; margin-bottom:15px;"><h4 style="margin-top:0; color:#721c24;">📄 解析失败的文件</h4><ul style="padding-left:20px; color:#721c24; font-size:12px;">{items}</ul></div>"""
 
     html = f"""
     <div style="font-family:sans-serif; max-width:600px; padding:20px; border:1px solid #ddd; border-radius:8px;">
@@ -269,11 +2005,18 @@ def generate_html_report(data):
             <p><b>📚 学科:</b> {SUBJECT}</p>
             <p><b>🚀 状态:</b> {data['success_chunks']} 成功 / <span style="color:red">{data['failed_chunks']} 失败</span></p>
             <p><b>⏱️ 耗时:</b> {data['duration']:.1f}s</p>
+            <p><b>🚦 限流:</b> {data.get('throttled', 0)} 次 / 最终并发 {data.get('final_concurrency', '-')}</p>
             <p><b>📝 题目总数:</b> {data['total_questions']}</p>
             <p><b>📄 处理文件数:</b> {data['file_count']}</p>
+            <p><b>🗑️ 下线题目:</b> {data.get('retired_questions', 0)}</p>
+            <p><b>🧬 重复丢弃:</b> {data.get('duplicates_dropped', 0)}</p>
+            <p><b>☠️ 死信切片:</b> {data.get('dead_letters', 0)} (本次重放成功 {data.get('replayed', 0)})</p>
+            <p><b>💾 缓存:</b> {data.get('cache_hits', 0)} 命中 / {data.get('cache_misses', 0)} 未命中</p>
+            {validate_html}
         </div>
-        <h4 style="margin:10px 0;">📜 运行日志</h4>
-        <div style="background:#fafafa; border:1px solid #eee; height:300px; overflow-y:auto; padding:10px; font-size:12px;">{log_html}</div>
+        {parse_html}
+        {metrics_html(data.get('metrics', {}), data.get('slowest', []))}
+        {log_html}
     </div>
     """
     return title, html
@@ -282,6 +2025,7 @@ def generate_html_report(data):
 def send_pushplus(title, content):
     if not PUSHPLUS_TOKEN: return
     try:
+        import requests
         requests.post("http://www.pushplus.plus/send",
                       json={"token": PUSHPLUS_TOKEN, "title": title, "content": content, "template": "html"}, timeout=5)
     except:
@@ -290,6 +2034,9 @@ def send_pushplus(title, content):
 
 def send_email(title, content):
     if not SMTP_USER or not SMTP_PASS or not RECEIVER_EMAILS: return
+    import smtplib
+    from email.mime.text import MIMEText
+    from email.header import Header
     try:
         smtp_obj = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT)
         smtp_obj.login(SMTP_USER, SMTP_PASS)
@@ -309,76 +2056,398 @@ def send_email(title, content):
 
 
 # ================= 🚀 主程序 (实时保存版) =================
-def main():
-    st = time.time()
-    if not os.path.exists(INPUT_DIR): return
-    files = [f for f in os.listdir(INPUT_DIR) if f.endswith(".docx")]
-    if not files: return
+def iter_parsed(files):
+    """
+    用进程池并行解析文档，按文件顺序产出 (文件名, 切片, 错误)
+    只预读 PARSE_WORKERS * 2 个文件，避免解析结果堆满内存
+    """
+    if PARSE_WORKERS <= 0:
+        for fname in files:
+            yield (fname,) + read_docx_chunks(os.path.join(INPUT_DIR, fname))
+        return
+
+    with ProcessPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+        pending = collections.deque()
+        todo = iter(files)
+        for fname in todo:
+            pending.append((fname, pool.submit(read_docx_chunks, os.path.join(INPUT_DIR, fname))))
+            if len(pending) >= PARSE_WORKERS * 2: break
+        while pending:
+            fname, fut = pending.popleft()
+            nxt = next(todo, None)
+            if nxt: pending.append((nxt, pool.submit(read_docx_chunks, os.path.join(INPUT_DIR, nxt))))
+            try:
+                chunks, err = fut.result()
+            except Exception as e:
+                chunks, err = [], f"{type(e).__name__}: {e}"
+            yield fname, chunks, err
 
-    if not os.path.exists(OUTPUT_DIR): os.makedirs(OUTPUT_DIR)
 
-    # 计算目标文件名
-    exist_files = [f for f in os.listdir(OUTPUT_DIR) if f.startswith("output") and f.endswith(".json")]
-    next_idx = 1
-    for f in exist_files:
-        m = re.search(r'output(\d+)', f)
-        if m: next_idx = max(next_idx, int(m.group(1)) + 1)
-    target_file = os.path.join(OUTPUT_DIR, f"output{next_idx}.json")
+def produce_chunks(files, engine, results):
+    """
+    生产者线程：解析进程池产出的切片依次提交到共享执行引擎
+    用信号量限制在途切片数，解析永远只领先执行 QUEUE_DEPTH 个切片
+    结果通过 results 队列交回主线程：
+    ("file", 文件名, (切片数, 错误)) / ("chunk", 文件名, (future, 参数)) / ("error", None, 错误) / ("end", None, None)
+    已经报过 "file" 的文件，每个切片都一定会交回一个 "chunk" (提交失败时是带异常的 future)，主线程不会卡住
+    """
+    slots = threading.BoundedSemaphore(engine.workers + QUEUE_DEPTH)
 
-    log_record(f"🚀 [{SUBJECT}] 启动 | Key: {len(API_KEYS)} | 并发: {MAX_WORKERS}")
+    def on_done(fname, args):
+        def callback(fut):
+            slots.release()
+            results.put(("chunk", fname, (fut, args)))
 
-    all_qs = []
-    stats = {"file_count": len(files), "total_chunks": 0, "success_chunks": 0, "failed_chunks": 0}
+        return callback
+
+    try:
+        for fname, chunks, err in iter_parsed(files):
+            log_record(f"📄 正在处理: {fname} ({len(chunks)} 个切片)...")
+            results.put(("file", fname, (len(chunks), err)))
+            for i, (c, ans_key) in enumerate(chunks):
+                slots.acquire()
+                args = (c, i, ans_key, f"{fname}#{i}")
+                try:
+                    fut = engine.submit(args)
+                except Exception as e:
+                    # 提交失败 (如队列库被锁) 也交回结果，由主线程转入死信
+                    fut = concurrent.futures.Future()
+                    fut.set_exception(e)
+                fut.add_done_callback(on_done(fname, args))
+    except Exception as e:
+        # 解析阶段出错：还没报过的文件不进 manifest，下次运行重试
+        results.put(("error", None, f"{type(e).__name__}: {e}"))
+    finally:
+        results.put(("end", None, None))
 
-    # 循环处理每个文件
-    for fname in files:
-        log_record(f"📄 正在处理: {fname}...")
-        txt = read_docx(os.path.join(INPUT_DIR, fname))
-        if not txt: continue
 
-        chunks = get_chunks(txt, CHUNK_SIZE, OVERLAP)
-        stats['total_chunks'] += len(chunks)
-        total_c = len(chunks)
+def file_entry(base, ids):
+    """
+    manifest 里一个文件的登记：ids 按切片序号排好 (同一切片内保持原顺序)，chunks 记下每个 id 所在的切片
+    ids: {id: 切片序号}，切片按完成先后并入，这里排回原文顺序
+    """
+    pairs = sorted(ids.items(), key=lambda kv: kv[1] or 0)
+    return dict(base, ids=[qid for qid, _ in pairs], chunks=[idx for _, idx in pairs])
+
+
+def merge_chunk(tracker, fname, qs, idx=None):
+    """把一个切片的结果并入所属文件：补字段、去重，返回需要写入的题目"""
+    kept = []
+    for q in qs or []:
+        q['id'] = str(uuid.uuid4())
+        q['chapter'] = fname.replace(".docx", "")
+        q['category'] = normalize_category(q.get('category', '综合题'))
+        if 'analysis' not in q: q['analysis'] = ""
+        # 🧬 相邻切片可能重复产出同一道题，只保留更完整的那条
+        keep, replaced = tracker["dedup"].add(q, idx)
+        if not keep: continue
+        if replaced: tracker["ids"].pop(replaced, None)
+        tracker["ids"][q['id']] = idx
+        kept.append(q)
+    return kept
+
+
+def replay_dead_letters(dead_letters, manifest, engine, sink, stats, stage=None):
+    """重新提交死信切片，成功的题目追加到所属文件的登记里，返回仍然失败的死信"""
+    jobs = []
+    for d in dead_letters:
+        entry = manifest["files"].get(d["file"])
+        if not entry or entry.get("sha256") != d["sha256"]: continue
+        job = f"{d['file']}#{d['idx']}"
+        if JOURNAL: JOURNAL.mark(job, chunk_cache_key(d["chunk"], d["ans_key"]), "pending")
+        jobs.append((d, engine.submit((d["chunk"], d["idx"], d["ans_key"], job))))
+    log_record(f"🔁 重放死信 {len(jobs)} 个切片...")
+
+    replayed, trackers = set(), {}
+    for d, fut in jobs:
+        try:
+            qs, err, msg = fut.result()
+        except Exception as e:
+            qs, err, msg = None, str(e), ""
+        if err:
+            d["error"] = err
+            log_record(f"[{d['file']} 死信] ❌ {err}", "ERROR")
+            continue
+        tracker = trackers.setdefault(d["file"], {"ids": {}, "dedup": DedupIndex()})
+        kept = merge_chunk(tracker, d["file"], qs, d["idx"])
+        if stage: stage.validate(kept)
+        sink.append(kept)
+        replayed.add((d["file"], d["idx"]))
+        log_record(f"[{d['file']} 死信] {msg}")
+
+    for fname, tracker in trackers.items():
+        # 重放出的题目按切片序号插回原位，而不是接在文件末尾
+        entry = manifest["files"][fname]
+        ids = dict(zip(entry["ids"], entry.get("chunks") or [0] * len(entry["ids"])))
+        ids.update(tracker["ids"])
+        manifest["files"][fname] = file_entry(entry, ids)
+    if trackers: atomic_write_json(MANIFEST_FILE, manifest, indent=2)
+    stats['replayed'] = len(replayed)
+    # 同一切片的重复旧记录也一并去掉
+    return [d for d in dead_letters if (d["file"], d["idx"]) not in replayed]
+
+
+def main(engine=None, notify=True, replay=None, validate=None):
+    """
+    engine：常驻模式传入预热好的执行引擎跨轮复用；不传则本轮临时创建
+    replay / validate：是否重放死信、是否融合校验，不传则取 REPLAY / FUSED_VALIDATE (环境变量与配置)
+    """
+    replay = REPLAY if replay is None else replay
+    validate = FUSED_VALIDATE if validate is None else validate
+    st = time.time()
+    if not os.path.exists(INPUT_DIR): return
+    files = sorted(f for f in os.listdir(INPUT_DIR) if f.endswith(".docx"))
 
-        # 处理当前文件的所有切片
-        current_file_qs = []
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as exc:
-            futures = [exc.submit(process_chunk, (c, i, "")) for i, c in enumerate(chunks)]
+    if not os.path.exists(OUTPUT_DIR): os.makedirs(OUTPUT_DIR)
+    manifest = load_manifest()
+
+    if not files:
+        # input/ 被 signal_clean 清空：封存当前题库，下一批文件写入新的 output{N}.json
+        if manifest["target"]:
+            atomic_write_json(MANIFEST_FILE, {"target": None, "files": {}}, indent=2)
+            log_record(f"🧹 输入目录已清空，{manifest['target']} 已封存")
+        return
+
+    # 📒 增量判定：只有新增/修改的文件需要重新切片
+    target_file = manifest["target"]
+    if not target_file or not bank_exists(target_file):
+        target_file, manifest["files"] = next_output_file(), {}
+
+    changed, deleted, fingerprints = diff_inputs(files, manifest)
+    retired = sum(len(manifest["files"].get(fname, {}).get("ids", [])) for fname in changed + deleted)
+    # 文件改了/删了，它之前的死信也就过期了 (改过的文件会重新生成)
+    dead_letters = [d for d in load_dead_letters() if d["file"] not in changed and d["file"] not in deleted]
+    for fname in deleted:
+        manifest["files"].pop(fname)
+        log_record(f"🗑️ {fname} 已删除，下线其题目")
+    for fname, fp in fingerprints.items():
+        if fname not in changed: manifest["files"][fname].update(fp)
+    manifest["target"] = target_file
+    # 提交第一个切片之前先把目标题库记进 manifest：中途被杀，重启后沿用同一题库与任务日志续跑
+    if changed: atomic_write_json(MANIFEST_FILE, manifest, indent=2)
+
+    log_record(f"🚀 [{SUBJECT}] 启动 | Key: {len(API_KEYS)} | 引擎: {ENGINE} | "
+               f"并发: {MAX_WORKERS}→{int(RATE.max_limit)} (自适应) | "
+               f"变更: {len(changed)} / 删除: {len(deleted)} / 未变: {len(files) - len(changed)}")
+
+    stats = {"file_count": len(changed), "total_chunks": 0, "success_chunks": 0, "failed_chunks": 0,
+             "retired_questions": retired, "duplicates_dropped": 0, "parse_errors": [], "replayed": 0}
+    sink = QuestionSink(target_file)
+    # 常驻模式跨轮复用同一进程：指标、缓存命中与限流次数每轮从零统计
+    METRICS.reset()
+    cache = get_chunk_cache()
+    if cache: cache.reset_counts()
+    throttled = RATE.snapshot()["throttled"]
+    try:
+        METRICS.open(os.path.join(METRICS_DIR, "converter.ndjson"))
+    except OSError as e:
+        log_record(f"指标文件不可写，只保留内存中的汇总: {e}", "WARN")
 
-            for i, fut in enumerate(as_completed(futures)):
-                # ✅ 此时这里的 unpack 一定是安全的 3 个值
-                qs, err, msg = fut.result()
+    global JOURNAL
+    journal_path = os.path.join(CACHE_DIR, f"journal-{hashlib.sha1(os.path.abspath(target_file).encode()).hexdigest()[:12]}.ndjson")
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        JOURNAL = JobJournal(journal_path)
+        if JOURNAL.jobs: log_record(f"📓 发现未完成的任务日志 ({len(JOURNAL.jobs)} 条)，从断点续跑")
+    except OSError as e:
+        log_record(f"任务日志不可用，本次无法断点续跑: {e}", "WARN")
+
+    # 🏭 全局流水线：解析/切片线程往有界队列里喂切片，所有文件的切片共用一个执行引擎
+    results = queue.Queue()
+    files_left = {}  # fname -> [剩余切片数, 切片总数, 已产出 id]
+    stage = ValidationStage() if validate else None
+    if stage: log_record("🔍 融合模式：抽取与校验并行，共用同一个限流器")
+
+    def commit_file(fname, tracker):
+        # ✅ 文件全部切片完成 (融合模式下还要等校验完)，登记到 manifest 即视为提交
+        del files_left[fname]
+        stats['duplicates_dropped'] += tracker["dedup"].dropped
+        manifest["files"][fname] = file_entry(fingerprints[fname], tracker["ids"])
+        atomic_write_json(MANIFEST_FILE, manifest, indent=2)
+        log_record(f"💾 {fname} 处理完毕，新增 {len(tracker['ids'])} 题，"
+                   f"去重 {tracker['dedup'].dropped} 题 (已存档)")
+
+    with (contextlib.nullcontext(engine) if engine else make_engine()) as engine:
+        producer = threading.Thread(target=produce_chunks, args=(changed, engine, results), daemon=True)
+        producer.start()
+
+        producing = True
+        while producing or files_left:
+            kind, fname, payload = results.get()
+
+            if kind == "end":
+                producing = False
+            elif kind == "error":
+                stats['parse_errors'].append(f"切片生产中断: {payload}")
+                log_record(f"🏭 切片生产中断，其余文件下次运行重试: {payload}", "ERROR")
+            elif kind == "file":
+                # 先撤下旧登记：文件处理到一半崩溃时，旧题目不会和新题目同时生效
+                manifest["files"].pop(fname, None)
+                n_chunks, err = payload
+                if err:
+                    # 解析失败不写入 manifest，下次运行会重试
+                    stats['parse_errors'].append(f"{fname}: {err}")
+                    log_record(f"📄 {fname} 解析失败: {err}", "ERROR")
+                if err or n_chunks == 0:
+                    if not err: manifest["files"][fname] = file_entry(fingerprints[fname], {})
+                    atomic_write_json(MANIFEST_FILE, manifest, indent=2)
+                    continue
+                stats['total_chunks'] += n_chunks
+                files_left[fname] = {"left": n_chunks, "total": n_chunks, "ids": {}, "dedup": DedupIndex(),
+                                     "validating": 0}
+            elif kind == "validated":
+                tracker = files_left[fname]
+                tracker["validating"] -= 1
+                sink.append(payload)
+                if tracker["left"] == 0 and tracker["validating"] == 0: commit_file(fname, tracker)
+            elif kind == "chunk":
+                tracker = files_left[fname]
+                tracker["left"] -= 1
+                done = tracker["total"] - tracker["left"]
+                fut, args = payload
+                try:
+                    # ✅ 此时这里的 unpack 一定是安全的 3 个值
+                    qs, err, msg = fut.result()
+                except Exception as e:
+                    qs, err, msg = None, str(e), ""
 
                 if err:
                     stats['failed_chunks'] += 1
-                    log_record(f"[{i + 1}/{total_c}] ❌ {err}", "ERROR")
+                    log_record(f"[{fname} {done}/{tracker['total']}] ❌ {err} -> 已转入死信", "ERROR")
+                    drop_dead_letter(dead_letters, fname, args[1])
+                    dead_letters.append({"file": fname, "sha256": fingerprints[fname]["sha256"], "idx": args[1],
+                                         "chunk": args[0], "ans_key": args[2], "error": err})
+                    atomic_write_json(DEAD_LETTER_FILE, dead_letters, indent=2)
                 else:
                     stats['success_chunks'] += 1
-                    log_record(f"[{i + 1}/{total_c}] {msg}")
-                    if qs:
-                        for q in qs:
-                            q['id'] = str(uuid.uuid4())
-                            q['number'] = len(all_qs) + len(current_file_qs) + 1
-                            q['chapter'] = fname.replace(".docx", "")
-                            q['category'] = normalize_category(q.get('category', '综合题'))
-                            if 'analysis' not in q: q['analysis'] = ""
-                            current_file_qs.append(q)
-
-        # ✅ 【实时保存】处理完一个文件，立刻写入总表和文件
-        all_qs.extend(current_file_qs)
-        log_record(f"💾 {fname} 处理完毕，当前总题数: {len(all_qs)} (已存档)")
-
-        final_data = {"version": "MultiKey-V13-AutoSave", "subject": SUBJECT, "data": all_qs}
-        with open(target_file, 'w', encoding='utf-8') as f:
-            json.dump(final_data, f, ensure_ascii=False, indent=2)
+                    log_record(f"[{fname} {done}/{tracker['total']}] {msg}")
+                    if drop_dead_letter(dead_letters, fname, args[1]):
+                        atomic_write_json(DEAD_LETTER_FILE, dead_letters, indent=2)
+                    kept = merge_chunk(tracker, fname, qs, args[1])
+                    if stage:
+                        # 🔍 先校验再落盘，抽取继续往下跑
+                        tracker["validating"] += 1
+                        stage.submit(fname, kept, results)
+                    else:
+                        # ✅ 【实时保存】每个切片的题目只追加写一次 (被替换的旧记录在压实时丢弃)
+                        sink.append(kept)
+
+                if tracker["left"] == 0 and tracker["validating"] == 0: commit_file(fname, tracker)
+
+        # 🔁 重放死信：只重放所属文件仍在 manifest 且内容未变的切片
+        if replay and dead_letters:
+            dead_letters = replay_dead_letters(dead_letters, manifest, engine, sink, stats, stage)
+
+    if stage:
+        stats.update(stage.close())
+        log_record(f"🔍 校验 {stats['validated']} 题，存疑 {stats['doubts']} 题 "
+                   f"(规则 {stats['rule_flagged']} / 复用结论 {stats['verdict_cached']} / 失败 {stats['validate_errors']})")
+    if changed or deleted or stats['replayed'] or os.path.exists(DEAD_LETTER_FILE):
+        atomic_write_json(DEAD_LETTER_FILE, dead_letters, indent=2)
+    if JOURNAL:
+        JOURNAL.clear()
+        JOURNAL = None
+
+    # 压实顺序：文件按文件名 (与 input/ 的处理顺序一致)，文件内按切片顺序；重抽的文件不会挪到末尾
+    live_ids = [qid for fname in sorted(manifest["files"]) for qid in manifest["files"][fname].get("ids", [])]
+    if changed or deleted or stats['replayed']:
+        atomic_write_json(MANIFEST_FILE, manifest, indent=2)
+        if COMPACT_OUTPUT:
+            sink.compact(live_ids, stage.v.mark_validated if stage else None)
+            log_record(f"📦 已压实为 {bank_path(target_file)}")
+    else:
+        log_record("📒 输入文件均未变化，跳过生成")
+    sink.close()
+    with open(LAST_FILE, "w", encoding="utf-8") as f:
+        f.write(bank_path(target_file))
 
     stats['duration'] = time.time() - st
-    stats['total_questions'] = len(all_qs)
+    stats['total_questions'] = len(live_ids)
+    if cache:
+        stats['cache_hits'], stats['cache_misses'] = cache.hits, cache.misses
+        log_record(f"💾 缓存命中 {cache.hits} / 未命中 {cache.misses}")
+    rate = RATE.snapshot()
+    stats['throttled'], stats['final_concurrency'] = rate['throttled'] - throttled, rate['limit']
+    log_record(f"🚦 限流 {stats['throttled']} 次，最终并发 {rate['limit']}")
+    stats['dead_letters'] = len(dead_letters)
+    if dead_letters: log_record(f"☠️ 死信 {len(dead_letters)} 个切片，见 {DEAD_LETTER_FILE} (python scripts/converter.py --replay 重放)", "WARN")
+    stats['metrics'], stats['slowest'] = METRICS.summary(), METRICS.top("chunk")
+    try:
+        METRICS.write_prometheus(os.path.join(METRICS_DIR, "converter.prom"))
+        log_record(f"📈 指标已导出到 {METRICS_DIR} (converter.ndjson / converter.prom)")
+    except OSError as e:
+        log_record(f"指标导出失败: {e}", "WARN")
+    METRICS.close()
     log_record(f"✨ 全部任务完成! 总耗时 {stats['duration']:.1f}s")
 
+    if not notify: return
     title, html = generate_html_report(stats)
     send_pushplus(title, html)
     send_email(title, html)
 
 
-if __name__ == "__main__": main()
\ No newline at end of file
+# ================= 👀 常驻监听 =================
+def input_signature():
+    # 只看目录元数据 (文件名/大小/修改时间)，不读文件内容
+    if not os.path.isdir(INPUT_DIR): return ()
+    with os.scandir(INPUT_DIR) as it:
+        return tuple(sorted((e.name, e.stat().st_size, e.stat().st_mtime_ns) for e in it if e.name.endswith(".docx")))
+
+
+def watch(replay=None, validate=None):
+    """
+    常驻模式 (--watch)：每 WATCH_INTERVAL 秒检查一次 input/
+    有变化且连续两次检查不再变动 (文件已拷贝完) 就跑一轮 main()，增量判定仍由 manifest 负责
+    执行引擎、Key 客户端、切片缓存、限流器学到的并发跨轮复用，不必每次冷启动一个进程
+    """
+    log_record(f"👀 常驻模式：监听 {INPUT_DIR}/，每 {WATCH_INTERVAL}s 检查一次 (Ctrl+C 退出)")
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    done, seen = None, None
+    with make_engine() as engine:
+        try:
+            while True:
+                sig = input_signature()
+                if sig != done and sig == seen:
+                    try:
+                        main(engine, WATCH_NOTIFY, replay, validate)
+                    except Exception as e:
+                        log_record(f"本轮转换异常，等输入再次变化后重试: {type(e).__name__}: {e}", "ERROR")
+                    done = sig
+                seen = sig
+                time.sleep(WATCH_INTERVAL)
+        except KeyboardInterrupt:
+            log_record("👋 常驻模式已退出")
+
+
+# ================= 🛰️ 分布式 worker =================
+def worker():
+    """
+    分布式模式的工作进程 (--worker)：任意多台机器各起一个，指向同一个 QUEUE_DB
+    领取协调进程发布的切片，用本机的 Key 客户端、切片缓存、限流器处理，结果写回队列由协调进程合并
+    空闲超过 QUEUE_IDLE_EXIT 秒自动退出 (0 表示常驻)
+    """
+    owner = f"{socket.gethostname()}-{os.getpid()}"
+    log_record(f"🛰️ worker {owner} 已启动 | 队列: {QUEUE_DB}")
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    count = 0
+    with make_local_engine() as engine:
+        try:
+            count = run_worker(ChunkQueue(QUEUE_DB), engine, owner, threading.Event(), QUEUE_IDLE_EXIT, True)
+        except KeyboardInterrupt:
+            pass
+    log_record(f"🛰️ worker {owner} 退出，共处理 {count} 个切片 | 🚦 {RATE.snapshot()}")
+
+
+if __name__ == "__main__":
+    if not API_KEYS:
+        print("❌ 严重错误：ZHIPU_KEY_POOL 为空！")
+        exit(1)
+    # --worker 分布式工作进程 / --watch 常驻监听 input/ / 默认跑一轮增量转换；--replay、--validate 见 REPLAY、FUSED_VALIDATE
+    args = sys.argv[1:]
+    replay, validate = "--replay" in args or None, "--validate" in args or None
+    if "--worker" in args:
+        worker()
+    elif "--watch" in args:
+        watch(replay, validate)
+    else:
+        main(replay=replay, validate=validate)
\ No newline at end of file
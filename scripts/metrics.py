@@ -0,0 +1,154 @@
+import bisect
+import collections
+import heapq
+import json
+import os
+import threading
+import time
+from atomicfile import atomic_open
+
+# ================= 📈 结构化指标 (converter / validator 共用) =================
+# 每个切片 / 每次请求记一条结构化事件，取代拼好的 HTML 日志字符串：
+#   - 最近 capacity 条放在环形缓冲区，内存有上限
+#   - open() 之后每条事件同时追加一行 NDJSON，完整保留供事后分析
+#   - 数值字段按固定桶累计直方图，可导出 Prometheus textfile (node_exporter textfile collector 直接读取)
+#   - 每类事件单独保留最慢的 N 条，报告里列出
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+PARSE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 20, 50)
+
+# 字段名 -> (直方图的桶, Prometheus 指标后缀)；不在表里的字段只进事件，不做聚合
+HISTOGRAM_FIELDS = {
+    "queue_wait": (SECONDS_BUCKETS, "queue_wait_seconds"),
+    "latency": (SECONDS_BUCKETS, "latency_seconds"),
+    "total": (SECONDS_BUCKETS, "duration_seconds"),
+    "parse_time": (PARSE_BUCKETS, "parse_seconds"),
+    "prompt_tokens": (TOKEN_BUCKETS, "prompt_tokens"),
+    "completion_tokens": (TOKEN_BUCKETS, "completion_tokens"),
+    "retries": (COUNT_BUCKETS, "retries"),
+}
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最后一格是 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """桶内线性插值估算分位数；落在 +Inf 桶里的按最大边界算"""
+        if not self.count: return 0.0
+        rank, seen = q * self.count, 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                if i == len(self.bounds): return float(self.bounds[-1])
+                low = self.bounds[i - 1] if i else 0.0
+                return low + (self.bounds[i] - low) * (rank - seen) / c
+            seen += c
+        return float(self.bounds[-1])
+
+
+class MetricsRecorder:
+    def __init__(self, prefix, capacity=2000, slow_n=10):
+        self.prefix = prefix
+        self.events = collections.deque(maxlen=capacity)
+        self.slow_n = slow_n
+        self.slowest = {}  # kind -> 小顶堆 [(值, 序号, 事件)]
+        self.hists = {}  # (kind, 字段) -> Histogram
+        self.outcomes = collections.Counter()  # (kind, outcome) -> 次数
+        self.seq = 0
+        self.sink = None
+        self.lock = threading.Lock()
+
+    def open(self, ndjson_path):
+        """开始把事件写入 NDJSON (每次运行覆盖上一次的文件)"""
+        os.makedirs(os.path.dirname(ndjson_path) or ".", exist_ok=True)
+        self.sink = open(ndjson_path, "w", encoding="utf-8")
+
+    def reset(self):
+        """清空事件、直方图与计数；常驻进程每轮开始时调用，汇总只反映本轮"""
+        with self.lock:
+            self.events.clear()
+            self.slowest, self.hists = {}, {}
+            self.outcomes = collections.Counter()
+            self.seq = 0
+
+    def close(self):
+        if self.sink:
+            self.sink.close()
+            self.sink = None
+
+    def record(self, kind, outcome="ok", slow_by=None, **fields):
+        """记一条事件；slow_by 指定按哪个字段排进「最慢 N 条」"""
+        event = dict(ts=round(time.time(), 3), kind=kind, outcome=outcome, **fields)
+        with self.lock:
+            self.seq += 1
+            self.events.append(event)
+            self.outcomes[(kind, outcome)] += 1
+            for name, value in fields.items():
+                spec = HISTOGRAM_FIELDS.get(name)
+                if spec is None or value is None: continue
+                hist = self.hists.get((kind, name))
+                if hist is None: hist = self.hists[(kind, name)] = Histogram(spec[0])
+                hist.observe(value)
+            if slow_by and fields.get(slow_by) is not None:
+                heap = self.slowest.setdefault(kind, [])
+                item = (fields[slow_by], self.seq, event)
+                if len(heap) < self.slow_n:
+                    heapq.heappush(heap, item)
+                else:
+                    heapq.heappushpop(heap, item)
+            if self.sink:
+                self.sink.write(json.dumps(event, ensure_ascii=False) + "\n")
+                self.sink.flush()
+        return event
+
+    # ---------- 汇总 ----------
+    def summary(self):
+        """{kind: {"count", "outcomes", "fields": {字段: {p50, p95, p99, sum}}}}"""
+        with self.lock:
+            out = {}
+            for (kind, outcome), n in self.outcomes.items():
+                entry = out.setdefault(kind, {"count": 0, "outcomes": {}, "fields": {}})
+                entry["count"] += n
+                entry["outcomes"][outcome] = n
+            for (kind, name), hist in self.hists.items():
+                out[kind]["fields"][name] = {
+                    "p50": round(hist.quantile(0.5), 4), "p95": round(hist.quantile(0.95), 4),
+                    "p99": round(hist.quantile(0.99), 4), "sum": round(hist.sum, 3), "count": hist.count}
+            return out
+
+    def top(self, kind):
+        with self.lock:
+            return [event for _, _, event in sorted(self.slowest.get(kind, []), reverse=True)]
+
+    def write_prometheus(self, path):
+        """导出 Prometheus textfile：直方图 + 按 outcome 计数，原子替换"""
+        lines = []
+        with self.lock:
+            for (kind, name), hist in sorted(self.hists.items()):
+                metric = f"{self.prefix}_{kind}_{HISTOGRAM_FIELDS[name][1]}"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, c in zip(hist.bounds, hist.counts):
+                    cumulative += c
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {hist.count}')
+                lines.append(f"{metric}_sum {hist.sum}")
+                lines.append(f"{metric}_count {hist.count}")
+            kinds = sorted({kind for kind, _ in self.outcomes})
+            for kind in kinds:
+                metric = f"{self.prefix}_{kind}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for (k, outcome), n in sorted(self.outcomes.items()):
+                    if k == kind: lines.append(f'{metric}{{outcome="{outcome}"}} {n}')
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with atomic_open(path, "w", "utf-8") as f:
+            f.write("\n".join(lines) + "\n")
@@ -0,0 +1,214 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+
+# ================= 🚦 限流与自适应并发 (converter / validator 共用) =================
+# 智谱接口限流时返回 HTTP 429，body 里的业务码：
+#   1302 并发数过高 / 1303 频率过高 / 1305 服务繁忙  -> 降速后重试
+#   1113 / 1304 余额或额度不足、401 鉴权失败          -> 该 Key 暂时停用，换 Key 重试
+#   1301 内容安全拦截、1261 输入过长、400 参数错误    -> 重试也没用
+THROTTLE_CODES = {"1302", "1303", "1305"}
+KEY_DEAD_CODES = {"1113", "1304"}
+FATAL_CODES = {"1301", "1261"}
+
+
+def parse_retry_after(value):
+    if not value: return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(e):
+    """
+    把 SDK / httpx 抛出的异常归类，返回 (类别, Retry-After 秒数)
+    类别：throttle 被限流 / key 该 Key 不可用 / fatal 不可重试 / timeout 超时 / error 其他临时错误
+    """
+    response = getattr(e, "response", None)
+    status = getattr(e, "status_code", None) or getattr(response, "status_code", None)
+    retry_after, code = None, ""
+    if response is not None:
+        try:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        except AttributeError:
+            pass
+        try:
+            code = str(response.json().get("error", {}).get("code", ""))
+        except Exception:
+            pass
+
+    name = type(e).__name__.lower()
+    # 余额不足 (1113) 也是 HTTP 429，先看业务码再看状态码
+    if status in (401, 403) or code in KEY_DEAD_CODES: return "key", retry_after
+    if status == 429 or code in THROTTLE_CODES: return "throttle", retry_after
+    if code in FATAL_CODES or status in (400, 422): return "fatal", None
+    if "timeout" in name or isinstance(e, (TimeoutError, asyncio.TimeoutError)): return "timeout", None
+    return "error", retry_after
+
+
+class NoKeyAvailable(Exception):
+    """拿不到可用的 Key：全部 Key 已失效，或等到调用方给的期限也没有名额"""
+
+
+class TokenBucket:
+    """每个 Key 一个令牌桶：rate 为每秒补充的请求数，capacity 为允许的突发量"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0  # 收到 429 后的冷却截止时间
+        self.dead_until = 0.0  # 额度用完 / 鉴权失败后的停用截止时间
+
+    def wait_time(self, now):
+        until = max(self.blocked_until, self.dead_until)
+        if now < until: return until - now
+        if self.rate <= 0: return 0.0
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1: return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate > 0: self.tokens -= 1
+
+
+class RateController:
+    """
+    按接口实际反馈调节速度，取代固定并发 + 盲目 sleep：
+    - 每个 Key 一个令牌桶 (key_rpm)，请求在有令牌的 Key 里挑在途数最少的 (并列时轮转)，
+      不限速 (key_rpm=0) 时也均摊到整个 Key 池，单个 Key 不会先撞上服务端的并发上限
+    - 在途请求上限按 AIMD 调整：成功且延迟正常时缓慢加 1，被限流/超时时减半
+    - 429 的 Retry-After 会让对应 Key 冷却，而不是整个进程一起睡
+    线程里用 acquire()，协程里用 acquire_async()，两者共享同一份状态
+    """
+
+    def __init__(self, keys, key_rpm=0, burst=5, start=4, max_limit=32, min_limit=1):
+        self.buckets = {k: TokenBucket(key_rpm / 60.0, burst) for k in keys}
+        self.keys = list(self.buckets)
+        self.key_in_flight = dict.fromkeys(self.keys, 0)
+        self.turn = 0  # 轮转起点
+        self.limit = float(start)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.baseline = None  # 正常延迟基线 (慢速跟随的最小值)
+        self.last_cut = 0.0
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+
+    # ---------- 申请 / 归还 ----------
+    def _try_acquire(self):
+        """返回 (key, 0) 表示拿到名额；否则返回 (None, 建议等待秒数)；Key 全部失效时抛 NoKeyAvailable"""
+        now = time.monotonic()
+        if all(b.dead_until > now for b in self.buckets.values()):
+            raise NoKeyAvailable(f"全部 {len(self.buckets)} 个 Key 均已失效 (额度用完或鉴权失败)")
+        if self.in_flight >= int(self.limit): return None, 0.05
+        n = len(self.keys)
+        best, best_wait = None, None
+        for i in range(n):
+            key = self.keys[(self.turn + i) % n]
+            w = self.buckets[key].wait_time(now)
+            if w > 0:
+                if best is None and (best_wait is None or w < best_wait): best_wait = w
+            elif best is None or self.key_in_flight[key] < self.key_in_flight[best]:
+                best, best_wait = key, 0.0
+        if best is None: return None, best_wait
+        self.buckets[best].take()
+        self.key_in_flight[best] += 1
+        self.in_flight += 1
+        self.turn = (self.keys.index(best) + 1) % n
+        return best, 0.0
+
+    def acquire(self, deadline=None):
+        """deadline：time.time() 时间戳，过了还没拿到名额就抛 NoKeyAvailable，不再无限等待"""
+        with self.cond:
+            while True:
+                key, wait = self._try_acquire()
+                if key is not None: return key
+                self.cond.wait(self._wait_slice(wait, deadline))
+
+    async def acquire_async(self, deadline=None):
+        while True:
+            with self.lock:
+                key, wait = self._try_acquire()
+            if key is not None: return key
+            await asyncio.sleep(self._wait_slice(wait, deadline))
+
+    @staticmethod
+    def _wait_slice(wait, deadline):
+        if deadline is None: return min(wait, 1.0)
+        left = deadline - time.time()
+        if left <= 0: raise NoKeyAvailable(f"等待可用 Key 超出期限 (还需 {wait:.0f}s)")
+        return min(wait, 1.0, left)
+
+    def release(self, key, latency=None, error=None):
+        """
+        请求结束后调用：error 为 None 表示成功，否则传入异常
+        返回错误类别 (成功时为 None)，交给 retry_delay / 调用方决定是否重试
+        """
+        kind, retry_after = classify_error(error) if error is not None else (None, None)
+        with self.cond:
+            self.in_flight -= 1
+            self.key_in_flight[key] -= 1
+            now = time.monotonic()
+            if kind is None:
+                self._on_success(latency)
+            elif kind in ("throttle", "timeout"):
+                self.throttled += 1
+                self._cut(now)
+                if kind == "throttle":
+                    cooldown = retry_after if retry_after is not None else random.uniform(1.0, 3.0)
+                    bucket = self.buckets[key]
+                    bucket.blocked_until = max(bucket.blocked_until, now + cooldown)
+            elif kind == "key":
+                # 额度用完/鉴权失败：这个 Key 停用 10 分钟，其余 Key 继续干活；全部停用时 acquire 直接报错
+                self.buckets[key].dead_until = now + (retry_after or 600.0)
+            self.cond.notify_all()
+        return kind
+
+    def cancel(self, key):
+        """请求被取消 (没有结果)：只归还名额，不计成功也不计失败，AIMD 与令牌桶都不动"""
+        with self.cond:
+            self.in_flight -= 1
+            self.key_in_flight[key] -= 1
+            self.cond.notify_all()
+
+    def _on_success(self, latency):
+        if latency is not None:
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline += (latency - self.baseline) * 0.01
+            # 延迟明显高于基线说明服务端已经吃紧，先不再加并发
+            if latency > self.baseline * 2.5: return
+        self.limit = min(self.max_limit, self.limit + 1.0 / max(self.limit, 1.0))
+
+    def _cut(self, now):
+        # 同一波限流只减一次，避免瞬间把并发砍到底
+        if now - self.last_cut < (self.baseline or 1.0): return
+        self.last_cut = now
+        self.limit = max(self.min_limit, self.limit / 2)
+
+    # ---------- 重试节奏 ----------
+    @staticmethod
+    def retry_delay(attempt, kind, base=1.0, cap=30.0):
+        """
+        限流/Key 失效：不必原地睡，冷却已经记在令牌桶上，acquire 会自动换 Key 或等到解禁
+        其他临时错误：指数退避 + 全抖动
+        """
+        if kind in ("throttle", "key"): return 0.0
+        return random.uniform(0, min(cap, base * (2 ** (attempt - 1))))
+
+    def snapshot(self):
+        with self.lock:
+            return {"limit": round(self.limit, 1), "in_flight": self.in_flight, "throttled": self.throttled}
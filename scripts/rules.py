@@ -0,0 +1,4 @@
+# ================= 📏 题目规则 (converter / validator 共用) =================
+# converter 本地解析据此把无选项的题判成判断题，validator 规则预检据此核对判断题答案；两边必须一致，
+# 否则本地解析出来的题会被预检直接标成存疑。比较前答案先去空白、转大写
+TRUE_FALSE_ANSWERS = {"对", "错", "正确", "错误", "√", "×", "✓", "✗", "T", "F", "TRUE", "FALSE", "是", "否", "Y", "N"}
@@ -0,0 +1,155 @@
+import gzip
+import json
+import os
+import re
+import hashlib
+from atomicfile import atomic_write
+
+# ================= 🗂️ 分片输出 (converter / validator 共用) =================
+# output_layout = "sharded" 时，题库 outputN 写成目录 output/outputN/：
+#   - 每个章节一个分片 {"version","subject","chapter","data":[...]}，紧凑编码，可选 gzip
+#     文件名带内容哈希，写好后不再修改；内容没变的章节不会重写，git 里也不会产生改动
+#   - index.json 记录每道题的 id / chapter / category / number -> 分片与字节偏移，是唯一的提交点：
+#     新分片先落盘，索引原子替换后才删除旧分片，读者任何时候看到的都是完整的一版
+#   - 读一章只打开一个分片；读一道题 seek 到偏移直接解析 (gzip 分片要解压到该偏移，也只涉及这一章)
+INDEX_NAME = "index.json"
+INDEX_FIELDS = ["id", "chapter", "category", "number", "offset", "length"]
+# 索引自己的簿记字段；其余顶层字段 (version / subject / validator 写的 source 等) 是题库头部
+INDEX_KEYS = ("gzip", "total", "shards", "fields", "questions")
+SHARD_HEAD = ("version", "subject")
+UNSAFE_NAME = re.compile(r'[\\/:*?"<>|\s]+')
+COMPACT = (',', ':')
+
+
+def shard_dir(target_file):
+    return os.path.splitext(target_file)[0]
+
+
+def index_path(target_file):
+    return os.path.join(shard_dir(target_file), INDEX_NAME)
+
+
+def encode_shard(head, chapter, questions):
+    """编码一个章节，返回 (字节, [(题目, 偏移, 长度)])；偏移按解压后的内容计算"""
+    prefix = json.dumps(dict(head, chapter=chapter), ensure_ascii=False, separators=COMPACT)[:-1] + ',"data":['
+    parts = [prefix.encode('utf-8')]
+    pos, spans = len(parts[0]), []
+    for i, q in enumerate(questions):
+        if i:
+            parts.append(b",")
+            pos += 1
+        body = json.dumps(q, ensure_ascii=False, separators=COMPACT).encode('utf-8')
+        spans.append((q, pos, len(body)))
+        parts.append(body)
+        pos += len(body)
+    parts.append(b"]}")
+    return b"".join(parts), spans
+
+
+def write_shard(root, head, chapter, questions, use_gzip):
+    """写一个章节分片 (同内容的分片已存在就跳过)，返回 (文件名, 索引行)"""
+    payload, spans = encode_shard(head, chapter, questions)
+    digest = hashlib.sha256(payload).hexdigest()[:12]
+    name = f"{UNSAFE_NAME.sub('_', chapter) or 'chapter'}.{digest}.json" + (".gz" if use_gzip else "")
+    path = os.path.join(root, name)
+    if not os.path.exists(path):
+        # mtime=0：同样的内容压出同样的字节
+        atomic_write(path, gzip.compress(payload, mtime=0) if use_gzip else payload)
+    rows = [[q.get('id'), chapter, q.get('category'), q.get('number'), offset, length]
+            for q, offset, length in spans]
+    return name, rows
+
+
+def commit_index(root, index):
+    """原子替换索引，然后删掉不再被引用的旧分片"""
+    atomic_write(os.path.join(root, INDEX_NAME), json.dumps(index, ensure_ascii=False, separators=COMPACT).encode('utf-8'))
+    live = {s["file"] for s in index["shards"].values()}
+    for name in os.listdir(root):
+        if name != INDEX_NAME and name not in live and (name.endswith(".json") or name.endswith(".json.gz")):
+            try:
+                os.remove(os.path.join(root, name))
+            except OSError:
+                pass
+
+
+def write_bank(target_file, head, chapters, use_gzip=False):
+    """
+    把整个题库写成分片 + 索引；chapters 为 [(章节, 题目列表)]，顺序即分片顺序
+    返回索引文件路径
+    """
+    root = shard_dir(target_file)
+    os.makedirs(root, exist_ok=True)
+    index = dict(head, gzip=use_gzip, total=0, shards={}, fields=INDEX_FIELDS, questions=[])
+    # 分片只带 version / subject：source 之类的头部字段变了不用重写所有分片
+    shard_head = {k: head[k] for k in SHARD_HEAD if k in head}
+    for chapter, qs in chapters:
+        name, rows = write_shard(root, shard_head, chapter, qs, use_gzip)
+        index["shards"][chapter] = {"file": name, "count": len(qs)}
+        index["questions"].extend(rows)
+    index["total"] = len(index["questions"])
+    commit_index(root, index)
+    return os.path.join(root, INDEX_NAME)
+
+
+# ---------- 读取 ----------
+def load_index(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def index_head(index):
+    """索引里的题库头部字段 (去掉簿记字段)"""
+    return {k: v for k, v in index.items() if k not in INDEX_KEYS}
+
+
+def open_shard(root, name):
+    return gzip.open(os.path.join(root, name), 'rb') if name.endswith(".gz") else open(os.path.join(root, name), 'rb')
+
+
+def load_chapter(path, chapter, index=None):
+    """只读一个章节的分片，返回题目列表"""
+    index = index or load_index(path)
+    shard = index["shards"].get(chapter)
+    if shard is None: raise KeyError(f"题库中没有章节: {chapter}")
+    with open_shard(os.path.dirname(path), shard["file"]) as f:
+        return json.loads(f.read())["data"]
+
+
+def load_question(path, qid, index=None):
+    """按 id 读一道题：定位分片和偏移后只解析这一条"""
+    index = index or load_index(path)
+    for row in index["questions"]:
+        if row[0] != qid: continue
+        _, chapter, _, _, offset, length = row
+        with open_shard(os.path.dirname(path), index["shards"][chapter]["file"]) as f:
+            f.seek(offset)
+            return json.loads(f.read(length))
+    raise KeyError(f"题库中没有题目: {qid}")
+
+
+def iter_questions(path):
+    """按分片顺序 (即题号顺序) 读出整个题库，一次只在内存里放一个章节"""
+    index = load_index(path)
+    for chapter in index["shards"]:
+        yield from load_chapter(path, chapter, index)
+
+
+def replace_chapters(path, chapters, **head):
+    """
+    只重写指定章节的分片 (如校验后 analysis 有变化)，其余分片原样保留
+    chapters: {章节: 题目列表}；head 里的字段会更新到索引上 (如 source)
+    """
+    index = load_index(path)
+    root = os.path.dirname(path)
+    shard_head = {k: index[k] for k in SHARD_HEAD if k in index}
+    rows = {}
+    for chapter, qs in chapters.items():
+        name, rows[chapter] = write_shard(root, shard_head, chapter, qs, index.get("gzip", False))
+        index["shards"][chapter] = {"file": name, "count": len(qs)}
+    for row in index["questions"]:
+        if row[1] not in chapters: rows.setdefault(row[1], []).append(row)
+    merged = []
+    for chapter in index["shards"]:
+        merged.extend(rows.get(chapter, []))
+    index.update(head, questions=merged, total=len(merged))
+    commit_index(root, index)
@@ -1,11 +1,17 @@
 import json
 import os
+import sys
 import time
-import requests
+import hashlib
+import threading
 import re
-from zhipuai import ZhipuAI
+from ratelimit import RateController
+from metrics import MetricsRecorder
+import shards
+from atomicfile import atomic_open
+from rules import TRUE_FALSE_ANSWERS
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from tqdm import tqdm
+# zhipuai / requests / tqdm 用到时才导入，融合模式或库调用 import 本模块时没有副作用
 
 # ================= 🛡️ 配置加载 =================
 CONFIG_FILE = "config.json"
@@ -42,14 +48,37 @@ def get_api_key():
 
 ZHIPU_API_KEY = get_api_key()
 AI_MODEL_NAME = "glm-4-flash"
-MAX_WORKERS = 20
-
-if not ZHIPU_API_KEY:
-    print("❌ 错误：无法获取 API Key")
-    # 这里使用 exit(0) 防止 action 标红，或者 exit(1) 强制报错，看你需求
-    exit(1)
-
-client = ZhipuAI(api_key=ZHIPU_API_KEY)
+MAX_WORKERS = 20  # 线程数 = 在途请求上限，实际在途数由 RATE 自适应
+MAX_RETRIES = 3  # 限流/超时等临时错误的重试次数
+RATE_CONFIG = APP_CONFIG.get("rate_limit", {})
+VALIDATE_MODE = APP_CONFIG.get("validate_mode", "batch")  # batch: 多题一个请求 / single: 一题一个请求
+BATCH_TOKENS = APP_CONFIG.get("validate_batch_tokens", 3000)  # 每个批次题目部分的 token 预算
+BATCH_MAX = APP_CONFIG.get("validate_batch_max", 20)  # 每个批次最多题数
+RUBRIC_VERSION = "V1"  # 修改审核提示词/判罚标准时务必递增，旧结论自动失效
+
+# 💾 结论缓存 (与 converter 的切片缓存放在同一目录)
+CACHE_DIR = os.getenv("CONVERTER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "auto-convert"))
+VERDICT_FILE = os.path.join(CACHE_DIR, "verdicts.json")
+VERDICT_MAX = APP_CONFIG.get("verdict_cache_max", 200000)  # 最多保留的结论条数
+
+# 📈 结构化指标 (与 converter 写到同一目录)：每次运行覆盖写 validator.ndjson / validator.prom
+METRICS_DIR = os.getenv("CONVERTER_METRICS_DIR", APP_CONFIG.get("metrics_dir", os.path.join(CACHE_DIR, "metrics")))
+METRICS = MetricsRecorder("validator", capacity=APP_CONFIG.get("metrics_buffer", 2000),
+                          slow_n=APP_CONFIG.get("report_slowest", 10))
+
+# converter 融合模式 (--validate) 下会把 RATE 换成 converter 的实例，校验与抽取共用同一个 Key 池
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+RATE = RateController([ZHIPU_API_KEY] if ZHIPU_API_KEY else [], key_rpm=RATE_CONFIG.get("key_rpm", 60), burst=RATE_CONFIG.get("burst", 5),
+                      start=4, max_limit=MAX_WORKERS)
+
+
+def get_client(key):
+    with CLIENTS_LOCK:
+        if key not in CLIENTS:
+            from zhipuai import ZhipuAI
+            CLIENTS[key] = ZhipuAI(api_key=key, max_retries=0)
+        return CLIENTS[key]
 
 
 # ================= 📧 报表推送 =================
@@ -76,8 +105,11 @@ def send_validation_report(data):
         </div>
         <ul style="padding-left:20px; margin-bottom:20px;">
             <li>📊 校验总数: <b>{data['total']}</b> 题</li>
+            <li>💾 复用结论: {data.get('cached', 0)} 题</li>
+            <li>📏 规则预检存疑: {data.get('rule_flagged', 0)} 题</li>
             <li>🤔 存疑数量: <b style="color:#d39e00;">{len(data['doubt_list'])}</b> 题</li>
             <li>❌ API失败: {len(data['api_errors'])} 次</li>
+            {metrics_line(data.get('metrics', {}))}
         </ul>
     """
 
@@ -92,18 +124,135 @@ def send_validation_report(data):
         html += f"""<div style="background:#f8d7da; padding:10px; border-radius:4px; border:1px solid #f5c6cb;"><h4 style="margin-top:0; color:#721c24;">❌ API 调用错误</h4><ul style="padding-left:20px; color:#721c24; font-size:12px;">{''.join([f'<li>{e}</li>' for e in data['api_errors'][:10]])}</ul></div>"""
 
     html += "</div>"
+    import requests
     requests.post("http://www.pushplus.plus/send",
                   json={"token": PUSHPLUS_TOKEN, "title": f"[{SUBJECT}] 质检报告", "content": html, "template": "html"},
                   timeout=5)
 
 
+def metrics_line(req):
+    if not req: return ""
+    f = req.get("fields", {})
+    lat = f.get("latency", {})
+    tokens = int(f.get("prompt_tokens", {}).get("sum", 0)) + int(f.get("completion_tokens", {}).get("sum", 0))
+    return (f"<li>📈 请求: {req.get('count', 0)} 次 | 延迟 p50 {lat.get('p50', 0):.2f}s / p95 {lat.get('p95', 0):.2f}s"
+            f" | Tokens {tokens}</li>")
+
+
 # ================= 🚀 校验逻辑 =================
-def validate_single(question):
+def call_model(prompt, max_tokens, parse=None):
+    """
+    经过限流器的单次调用：限流/超时会降速后重试，不可重试的错误直接抛出
+    parse 为回复的解析函数，解析耗时单独计入指标
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        key = RATE.acquire()
+        req_t = time.time()
+        try:
+            res = get_client(key).chat.completions.create(
+                model=AI_MODEL_NAME, messages=[{"role": "user", "content": prompt}],
+                temperature=0.1, max_tokens=max_tokens
+            )
+        except Exception as e:
+            kind = RATE.release(key, error=e)
+            METRICS.record("request", kind, attempt=attempt, latency=round(time.time() - req_t, 3))
+            if kind == "fatal" or attempt > MAX_RETRIES: raise
+            time.sleep(RATE.retry_delay(attempt, kind))
+            continue
+        latency = time.time() - req_t
+        RATE.release(key, latency=latency)
+        parse_t = time.perf_counter()
+        result = parse(res.choices[0].message.content) if parse else res.choices[0].message.content
+        usage = getattr(res, "usage", None)
+        METRICS.record("request", attempt=attempt, latency=round(latency, 3),
+                       prompt_tokens=getattr(usage, "prompt_tokens", None),
+                       completion_tokens=getattr(usage, "completion_tokens", None),
+                       parse_time=round(time.perf_counter() - parse_t, 5))
+        return result
+
+
+RUBRIC = """
+        [审核判罚标准]
+        1. **事实性错误 (Fatal Error)**：参考答案违反了学科公理、常识或标准指南。
+           - 例如：医学中使用了禁忌药；数学中 1+1=3；计算机中死锁条件错误。
+           - 判定：必须报错。
+        2. **逻辑/格式错误 (Logic Error)**：
+           - 单选题给出了多个答案（如 "AB"）。
+           - 多选题只给了一个答案（如 "A"）。
+           - 判断题答案不是对/错。
+           - 判定：必须报错。
+        3. **主观题宽容原则**：
+           - 对于“简答题”、“论述题”、“编程题”，只要参考答案的逻辑通顺、言之有理，即视为正确。不要吹毛求疵。
+"""
+
+
+def options_text(question):
     # 构造清晰的选项文本
-    options_text = ""
-    if question.get('options'):
-        options_text = "\n".join([f"{opt['label']}. {opt['text']}" for opt in question['options']])
+    if not question.get('options'): return ""
+    return "\n".join([f"{opt['label']}. {opt['text']}" for opt in question['options']])
+
+
+DOUBT_PREFIX = re.compile(r'^(?:【答案存疑】(?:AI提示|规则校验)：[\s\S]*?\n\n)+')
+
 
+def doubt_reason(text):
+    # 理由里不留空行，保证 DOUBT_PREFIX 能把旧提示完整剥掉
+    text = re.sub(r'\n\s*\n', '\n', text.strip())
+    return f"【答案存疑】AI提示：{text}\n\n"
+
+
+def strip_doubt(analysis):
+    return DOUBT_PREFIX.sub("", analysis or "")
+
+
+# ================= 📏 规则预检 =================
+SINGLE_CATEGORIES = ("A1型题", "A2型题", "B1型题", "单选题")
+
+
+def question_type(q):
+    qtype = str(q.get('type') or "").upper()
+    if qtype: return qtype
+    category = q.get('category') or ""
+    if category in SINGLE_CATEGORIES: return "SINGLE_CHOICE"
+    if category == "X型题": return "MULTI_CHOICE"
+    if category == "判断题": return "TRUE_FALSE"
+    return ""
+
+
+def precheck(q):
+    """
+    不调用模型就能判定的结构性错误，返回问题描述；没发现问题返回 None
+    命中的题目直接标记存疑，不再送去 LLM
+    """
+    if not str(q.get('content') or "").strip(): return "题干为空"
+
+    qtype = question_type(q)
+    answer = str(q.get('answer') or "").strip().upper()
+    if qtype not in ("SINGLE_CHOICE", "MULTI_CHOICE", "TRUE_FALSE"): return None
+    if not answer: return "缺少参考答案"
+
+    if qtype == "TRUE_FALSE":
+        if answer not in TRUE_FALSE_ANSWERS: return f"判断题答案不是对/错：{answer}"
+        return None
+
+    letters = re.findall(r'[A-Z]', answer)
+    if not letters: return f"选择题答案不是选项字母：{answer}"
+    if qtype == "SINGLE_CHOICE" and len(set(letters)) > 1: return f"单选题给出了多个答案：{answer}"
+    if qtype == "MULTI_CHOICE" and len(set(letters)) == 1: return f"多选题只给了一个答案：{answer}"
+
+    labels = {str(opt.get('label', '')).strip().upper() for opt in q.get('options') or [] if isinstance(opt, dict)}
+    missing = sorted(set(letters) - labels)
+    if labels and missing: return f"答案 {''.join(missing)} 不在选项中"
+    return None
+
+
+def rule_reason(text):
+    return f"【答案存疑】规则校验：{text}\n\n"
+
+
+def validate_single(question):
     prompt = f"""
         [系统角色]
         你是一位资深的**{SUBJECT}**学科专家和试题审核员。
@@ -117,24 +266,12 @@ def validate_single(question):
         {question['content']}
 
         【候选选项】：
-        {options_text}
+        {options_text(question)}
         --------------------------------------------------
 
         [给出的参考答案]
         {question['answer']}
-
-        [审核判罚标准]
-        1. **事实性错误 (Fatal Error)**：参考答案违反了学科公理、常识或标准指南。
-           - 例如：医学中使用了禁忌药；数学中 1+1=3；计算机中死锁条件错误。
-           - 判定：必须报错。
-        2. **逻辑/格式错误 (Logic Error)**：
-           - 单选题给出了多个答案（如 "AB"）。
-           - 多选题只给了一个答案（如 "A"）。
-           - 判断题答案不是对/错。
-           - 判定：必须报错。
-        3. **主观题宽容原则**：
-           - 对于“简答题”、“论述题”、“编程题”，只要参考答案的逻辑通顺、言之有理，即视为正确。不要吹毛求疵。
-
+{RUBRIC}
         [输出指令]
         请仅输出以下两种格式之一，不要包含其他废话：
 
@@ -146,62 +283,284 @@ def validate_single(question):
 
         """
     try:
-        res = client.chat.completions.create(
-            model=AI_MODEL_NAME, messages=[{"role": "user", "content": prompt}],
-            temperature=0.1, max_tokens=200
-        )
-        content = res.choices[0].message.content.strip()
+        content = call_model(prompt, 200, parse=str.strip)
         if "DOUBT" in content or "存疑" in content:
             reason = content.replace("DOUBT:", "").replace("DOUBT", "").strip()
-            return True, f"【答案存疑】AI提示：{reason}\n\n", None
+            return True, doubt_reason(reason), None
         return False, "", None
     except Exception as e:
         return False, "", str(e)
 
 
-def main():
+# ================= 💾 结论缓存 =================
+def question_fingerprint(q):
+    raw = json.dumps([RUBRIC_VERSION, SUBJECT, AI_MODEL_NAME, q.get('category'), q.get('type'),
+                      q.get('content'), q.get('options'), q.get('answer')], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class VerdictStore:
+    """
+    题目指纹 -> [是否存疑, 理由]，整体存成一个 JSON 文件
+    dict 的插入顺序即使用顺序：命中时移到末尾，超出 VERDICT_MAX 从头部淘汰 (LRU)
+    保存时先写临时文件再 os.replace
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                print("⚠️ 结论缓存损坏，已忽略")
+
+    def get(self, fp):
+        v = self.entries.pop(fp, None)
+        if v is not None: self.entries[fp] = v
+        return v
+
+    def put(self, fp, is_doubt, reason):
+        self.entries.pop(fp, None)
+        self.entries[fp] = [is_doubt, reason]
+        while len(self.entries) > self.max_entries:
+            del self.entries[next(iter(self.entries))]
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with atomic_open(self.path, 'w', 'utf-8') as f:
+                json.dump(self.entries, f, ensure_ascii=False)
+        except OSError as e:
+            print(f"⚠️ 结论缓存写入失败: {e}")
+
+
+# ================= 📦 批量校验 =================
+def question_block(qid, question):
+    return f"""
+        ---------------- 题目 {qid} ----------------
+        【学科章节】：{question.get('chapter', '未知章节')}
+        【题型分类】：{question.get('category', '未知题型')}
+        【题目内容】：{question.get('content', '')}
+        【候选选项】：
+        {options_text(question)}
+        【参考答案】：{question.get('answer', '')}
+"""
+
+
+def estimate_tokens(text):
+    # 保守估算：按字符数计 (中文约 1 字 1 token，英文只会更少)
+    return len(text)
+
+
+def make_batches(indexed):
+    """按 token 预算贪心打包 [(idx, question)]，超长单题独占一个批次"""
+    batch, used = [], 0
+    for idx, q in indexed:
+        cost = estimate_tokens(question_block(f"Q{idx}", q))
+        if batch and (used + cost > BATCH_TOKENS or len(batch) >= BATCH_MAX):
+            yield batch
+            batch, used = [], 0
+        batch.append((idx, q))
+        used += cost
+    if batch: yield batch
+
+
+def parse_verdicts(text):
+    """解析 [{"id","verdict","reason"}]，返回 id -> (是否存疑, 理由)；格式不对的条目直接忽略"""
+    text = text.strip()
+    if "```" in text:
+        text = text.split("```")[1]
+        if text.startswith("json"): text = text[4:]
+    start, end = text.find("["), text.rfind("]")
+    if start == -1 or end == -1: return {}
+    try:
+        items = json.loads(text[start:end + 1])
+    except ValueError:
+        return {}
+    verdicts = {}
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict): continue
+        verdict = str(item.get("verdict", "")).upper()
+        if verdict not in ("CORRECT", "DOUBT"): continue
+        verdicts[str(item.get("id", ""))] = (verdict == "DOUBT", str(item.get("reason", "")).strip())
+    return verdicts
+
+
+def validate_batch(batch):
+    """
+    一个请求审核一批题目，返回 {idx: (is_doubt, reason, err)}
+    缺失/格式错误的条目：对半拆分后重试，拆到单题时退回 validate_single
+    """
+    if len(batch) == 1:
+        idx, q = batch[0]
+        return {idx: validate_single(q)}
+
+    blocks = "".join(question_block(f"Q{idx}", q) for idx, q in batch)
+    prompt = f"""
+        [系统角色]
+        你是一位资深的**{SUBJECT}**学科专家和试题审核员。
+        你的任务是逐一审核下面 {len(batch)} 道刚刚从文档中提取出来的题目，判断每道题的“参考答案”是否存在明显错误。
+
+        [待审核题目列表]
+{blocks}
+{RUBRIC}
+        [输出指令]
+        只输出一个 JSON 数组，每道题一个对象，按题目编号一一对应，不要包含其他废话：
+        [{{"id": "题目编号", "verdict": "CORRECT 或 DOUBT", "reason": "存疑时简短说明错误理由并给出你认为的正确答案，正确时留空"}}]
+        """
+    try:
+        verdicts = call_model(prompt, min(4000, 100 + 120 * len(batch)), parse=parse_verdicts)
+    except Exception as e:
+        return {idx: (False, "", str(e)) for idx, _ in batch}
+
+    results, missing = {}, []
+    for idx, q in batch:
+        v = verdicts.get(f"Q{idx}")
+        if v is None:
+            missing.append((idx, q))
+        else:
+            results[idx] = (True, doubt_reason(v[1]), None) if v[0] else (False, "", None)
+    if missing:
+        if len(missing) == len(batch):
+            half = len(batch) // 2
+            results.update(validate_batch(batch[:half]))
+            results.update(validate_batch(batch[half:]))
+        else:
+            results.update(validate_batch(missing))
+    return results
+
+
+def timed(kind, fn, arg, size, submitted):
+    """线程池任务外面包一层：记录排队等待与总耗时"""
+    started = time.time()
+    try:
+        return fn(arg)
+    finally:
+        METRICS.record(kind, slow_by="total", questions=size, queue_wait=round(started - submitted, 3),
+                       total=round(time.time() - started, 3))
+
+
+def mark_validated(head):
+    """【核心修复】安全地更新 source 字段 (重复质检不重复追加)；converter 融合校验也用它"""
+    current_source = head.get('source', 'Unknown-Source')
+    if not current_source.endswith(" + Validated"):
+        head['source'] = current_source + " + Validated"
+
+
+def main(chapter=None):
+    """chapter：只校验这一章 (命令行 --chapter 章节名)，默认校验整个题库"""
+    if not ZHIPU_API_KEY:
+        print("❌ 错误：无法获取 API Key")
+        # 这里使用 exit(0) 防止 action 标红，或者 exit(1) 强制报错，看你需求
+        exit(1)
     if not os.path.exists("last_generated_file.txt"): return
     with open("last_generated_file.txt", "r") as f:
         target_file = f.read().strip()
     if not os.path.exists(target_file): return
 
-    print(f"🕵️‍♂️ 启动质检 | 目标: {target_file}")
-    with open(target_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-
-    questions = data['data']
+    print(f"🕵️‍♂️ 启动质检 | 目标: {target_file}" + (f" | 章节: {chapter}" if chapter else ""))
+    sharded = os.path.basename(target_file) == shards.INDEX_NAME
+    if sharded:
+        # 🗂️ 分片题库：只读要校验的章节，写回时也只重写这些分片
+        data = shards.load_index(target_file)
+        names = [chapter] if chapter else list(data["shards"])
+        chapters = {name: shards.load_chapter(target_file, name, data) for name in names}
+        questions = [q for qs in chapters.values() for q in qs]
+    else:
+        with open(target_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        questions = [q for q in data['data'] if not chapter or q.get('chapter') == chapter]
     stats = {
-        "filename": os.path.basename(target_file),
+        "filename": os.path.basename(os.path.dirname(target_file) if sharded else target_file),
         "total": len(questions),
         "doubt_list": [],
-        "api_errors": []
+        "api_errors": [],
+        "cached": 0,
+        "rule_flagged": 0
     }
 
+    store = VerdictStore(VERDICT_FILE, VERDICT_MAX)
+    try:
+        METRICS.open(os.path.join(METRICS_DIR, "validator.ndjson"))
+    except OSError as e:
+        print(f"⚠️ 指标文件不可写，只保留内存中的汇总: {e}")
+    fingerprints = [question_fingerprint(q) for q in questions]
+
+    def number(idx):
+        # 题号在 converter 压实时才编；没压实过 (compact_output 关闭) 或外部题库没有题号时，按在本次列表中的位置报
+        return questions[idx].get('number') or idx + 1
+
+    def apply(idx, verdict):
+        is_doubt, reason, err = verdict
+        if err:
+            stats['api_errors'].append(f"第 {number(idx)} 题: {err}")
+            return
+        store.put(fingerprints[idx], is_doubt, reason)
+        # 幂等：先剥掉上一轮的存疑提示再决定是否加上
+        analysis = strip_doubt(questions[idx].get('analysis', ""))
+        if is_doubt:
+            stats['doubt_list'].append(number(idx))
+            analysis = reason + analysis
+        questions[idx]['analysis'] = analysis
+
+    # 📏 规则预检 → 💾 复用上次结论 → 剩下的才送去 LLM
+    todo = []
+    for i, q in enumerate(questions):
+        problem = precheck(q)
+        if problem:
+            stats['rule_flagged'] += 1
+            stats['doubt_list'].append(number(i))
+            q['analysis'] = rule_reason(problem) + strip_doubt(q.get('analysis', ""))
+            continue
+        hit = store.get(fingerprints[i])
+        if hit is None:
+            todo.append((i, q))
+        else:
+            stats['cached'] += 1
+            apply(i, (hit[0], hit[1], None))
+    print(f"📏 规则预检存疑 {stats['rule_flagged']} 题 | 💾 复用结论 {stats['cached']} 题 | 需要校验 {len(todo)} 题")
+
+    from tqdm import tqdm
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as exc:
-        futures = {exc.submit(validate_single, q): i for i, q in enumerate(questions)}
-        for fut in tqdm(as_completed(futures), total=len(questions)):
-            idx = futures[fut]
-            try:
-                is_doubt, reason, err = fut.result()
-                if err:
-                    stats['api_errors'].append(f"第 {questions[idx]['number']} 题: {err}")
-                elif is_doubt:
-                    stats['doubt_list'].append(questions[idx]['number'])
-                    questions[idx]['analysis'] = reason + questions[idx].get('analysis', "")
-            except:
-                pass
-
-    data['data'] = questions
-
-    # 【核心修复】安全地更新 source 字段
-    current_source = data.get('source', 'Unknown-Source')
-    data['source'] = current_source + " + Validated"
-
-    with open(target_file, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-    print(f"✅ 质检完成！存疑: {len(stats['doubt_list'])}")
+        if VALIDATE_MODE == "single":
+            futures = {exc.submit(timed, "single", validate_single, q, 1, time.time()): [i] for i, q in todo}
+        else:
+            futures = {exc.submit(timed, "batch", validate_batch, b, len(b), time.time()): [i for i, _ in b]
+                       for b in make_batches(todo)}
+            print(f"📦 批量模式：{len(todo)} 题打包为 {len(futures)} 个请求")
+        with tqdm(total=len(todo)) as bar:
+            for fut in as_completed(futures):
+                try:
+                    res = fut.result()
+                    if VALIDATE_MODE == "single": res = {futures[fut][0]: res}
+                    for idx, verdict in res.items(): apply(idx, verdict)
+                except:
+                    pass
+                bar.update(len(futures[fut]))
+
+    store.save()
+
+    mark_validated(data)
+
+    if sharded:
+        shards.replace_chapters(target_file, chapters, source=data['source'])
+    else:
+        with open(target_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+    print(f"✅ 质检完成！存疑: {len(stats['doubt_list'])} | 🚦 {RATE.snapshot()}")
+    stats['metrics'] = METRICS.summary().get("request", {})
+    try:
+        METRICS.write_prometheus(os.path.join(METRICS_DIR, "validator.prom"))
+    except OSError as e:
+        print(f"⚠️ 指标导出失败: {e}")
+    METRICS.close()
     send_validation_report(stats)
 
 
-if __name__ == "__main__": main()
\ No newline at end of file
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    main(argv[argv.index("--chapter") + 1] if "--chapter" in argv[:-1] else None)
\ No newline at end of file